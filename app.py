@@ -9,17 +9,392 @@ from werkzeug.utils import secure_filename
 import threading
 import time
 from queue import Queue
+import hashlib
+import shutil
+import re
+import csv
+import zlib
+from collections import OrderedDict
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+try:
+    import orjson  # Optional - much faster JSON encoding; the json module is used without it
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow as pa  # Optional - match arrays are stored as memory-mapped Arrow files; pickled without it
+except ImportError:
+    pa = None
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['DOWNLOAD_FOLDER'] = 'downloads'
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
+app.config['REFERENCE_FOLDER'] = os.path.join('uploads', 'reference')  # Registered custom school datasets
+app.config['PARSED_CACHE_FOLDER'] = os.path.join('uploads', 'cache')  # Parsed uploads keyed by content hash
+app.config['PARSED_CACHE_MAX_MB'] = int(os.environ.get('PARSED_CACHE_MAX_MB', 512))
+app.config['RESULT_CACHE_FOLDER'] = os.path.join('downloads', 'cache')  # Finished analyses keyed by inputs + parameters
+app.config['RESULT_CACHE_MAX_MB'] = int(os.environ.get('RESULT_CACHE_MAX_MB', 2048))
+app.config['RESULT_CACHE_MAX_AGE_HOURS'] = float(os.environ.get('RESULT_CACHE_MAX_AGE_HOURS', 24 * 7))
+app.config['SESSION_DB'] = os.environ.get('SESSION_DB', os.path.join('uploads', 'sessions.db'))  # Shared by all workers
+# Analyses run in a process pool (per web worker process); uploads beyond the queue limit get a 429
+app.config['ANALYSIS_QUEUE_SIZE'] = int(os.environ.get('ANALYSIS_QUEUE_SIZE', 16))
+app.config['ANALYSIS_TIMEOUT_SECONDS'] = int(os.environ.get('ANALYSIS_TIMEOUT_SECONDS', 30 * 60))  # Wall-clock limit per job
+# Janitor - expires old sessions and their files, and keeps loaded results within a memory budget
+app.config['JANITOR_INTERVAL_SECONDS'] = int(os.environ.get('JANITOR_INTERVAL_SECONDS', 60))
+app.config['SESSION_TTL_HOURS'] = float(os.environ.get('SESSION_TTL_HOURS', 24))
+app.config['RESULTS_MEMORY_TTL_MINUTES'] = float(os.environ.get('RESULTS_MEMORY_TTL_MINUTES', 15))
+app.config['RESULTS_MEMORY_BUDGET_MB'] = int(os.environ.get('RESULTS_MEMORY_BUDGET_MB', 512))
+app.config['SESSION_FILES_BUDGET_MB'] = int(os.environ.get('SESSION_FILES_BUDGET_MB', 4096))  # Uploads + per-session downloads
+# Split one analysis across processes by government school ranges (1 = run in-process)
+app.config['PARTITION_WORKERS'] = int(os.environ.get('PARTITION_WORKERS', 1))
+app.config['PARTITION_MIN_SCHOOLS'] = int(os.environ.get('PARTITION_MIN_SCHOOLS', 5000))  # Smaller files are not worth the fan-out
+# Every web worker (WEB_CONCURRENCY, as gunicorn reads it) owns an analysis pool, and each analysis may fan
+# out to PARTITION_WORKERS processes - the default pool size shares the host's cores between them
+app.config['WEB_WORKERS'] = int(os.environ.get('WEB_CONCURRENCY', 1))
+app.config['ANALYSIS_WORKERS'] = int(os.environ.get(
+    'ANALYSIS_WORKERS', max(1, (os.cpu_count() or 1) // (app.config['WEB_WORKERS'] * app.config['PARTITION_WORKERS']))))
 
 ALLOWED_EXTENSIONS = {'csv', 'xlsx', 'xls'}
 
-# Store analysis sessions and their progress
-analysis_sessions = {}
-analysis_locks = {}
+# Proximity search settings
+# 'grid' uses the uniform lat/lon grid index, 'brute' compares against every custom school
+app.config['SPATIAL_INDEX'] = os.environ.get('SPATIAL_INDEX', 'grid')
+SEARCH_RADIUS_KM = 5.0  # Default search radius; /upload accepts radius_km up to MAX_SEARCH_RADIUS_KM
+DEFAULT_RINGS_KM = (2.0, 5.0, 10.0)  # Default distance ring boundaries: 0-2, 2-5, 5-10 and 10+ km
+# Rings subdivide the search radius; by default the boundaries above are cut off at the radius (5 km: 0-2, 2-5 and 5+ km)
+app.config['MAX_SEARCH_RADIUS_KM'] = float(os.environ.get('MAX_SEARCH_RADIUS_KM', 50))
+MAX_RINGS = 10
+# 'radius' finds every custom school within the radius, 'knn' the nearest k of each source at any distance
+ANALYSIS_MODES = ('radius', 'knn')
+MAX_NEAREST_K = 10
+# Memory budget for one (government block x custom schools) distance tile
+app.config['DISTANCE_BLOCK_MEMORY_MB'] = int(os.environ.get('DISTANCE_BLOCK_MEMORY_MB', 64))
+TILE_TEMPORARIES = 6  # float64 arrays of tile size alive at peak inside haversine_block
+EARTH_RADIUS_KM = 6371
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180  # ~111.195 km per degree of latitude
+
+class SessionStore:
+    """
+    Analysis session state in SQLite (WAL mode), shared by every gunicorn worker.
+    Holds status, progress counters, the summary and references to result files;
+    the results themselves stay on disk and are loaded lazily by the worker that needs them.
+    A few recent result rows per session are kept for the live progress stream.
+    Each update bumps the session's version so readers can tell when something changed.
+    """
+    FIELDS = ('status', 'progress', 'total', 'results_count', 'error', 'summary',
+              'results_file', 'excel_file', 'results_state_file', 'reference_id')
+    LIVE_RESULTS_KEPT = 5
+    ADDED_COLUMNS = {'cancel_requested': 'INTEGER NOT NULL DEFAULT 0', 'owner_pid': 'INTEGER'}
+    
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+    
+    def _connect(self):
+        # One connection per thread (and per process - connections must not cross a fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                progress INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                results_count INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                summary TEXT,
+                results_file TEXT,
+                excel_file TEXT,
+                results_state_file TEXT,
+                reference_id TEXT,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                version INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS live_results (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                result TEXT NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            );
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        # Columns added after the first release of the schema
+        existing = {row['name'] for row in conn.execute('PRAGMA table_info(sessions)')}
+        for column, definition in self.ADDED_COLUMNS.items():
+            if column not in existing:
+                try:
+                    conn.execute(f"ALTER TABLE sessions ADD COLUMN {column} {definition}")
+                except sqlite3.OperationalError:
+                    pass  # Added concurrently by another worker
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+    
+    def create(self, session_id, **fields):
+        now = time.time()
+        conn = self._connect()
+        conn.execute('INSERT INTO sessions (session_id, status, created_at, updated_at) VALUES (?, ?, ?, ?)',
+                     (session_id, fields.pop('status', 'initializing'), now, now))
+        if fields:
+            self.update(session_id, **fields)
+    
+    def create_queued(self, session_id, max_queued, **fields):
+        """
+        Create a session in the 'queued' state unless max_queued sessions are already waiting.
+        The check and insert are one statement, so concurrent workers cannot overfill the queue.
+        The creating process is recorded as owner - its analysis pool holds the job.
+        Returns False when the queue is full.
+        """
+        now = time.time()
+        cursor = self._connect().execute(
+            "INSERT INTO sessions (session_id, status, owner_pid, created_at, updated_at) "
+            "SELECT ?, 'queued', ?, ?, ? WHERE (SELECT COUNT(*) FROM sessions WHERE status = 'queued') < ?",
+            (session_id, os.getpid(), now, now, max_queued))
+        if cursor.rowcount == 0:
+            return False
+        if fields:
+            self.update(session_id, **fields)
+        return True
+    
+    def request_cancel(self, session_id):
+        """
+        Ask a session to stop. A queued session is cancelled right away (it leaves the queue);
+        a running one is flagged and stops at its next cancellation check.
+        Returns the session's status after the request, or None if unknown.
+        """
+        conn = self._connect()
+        now = time.time()
+        conn.execute("UPDATE sessions SET status = 'cancelled', error = 'Cancelled by user', cancel_requested = 1, "
+                     "version = version + 1, updated_at = ? WHERE session_id = ? AND status = 'queued'", (now, session_id))
+        conn.execute("UPDATE sessions SET cancel_requested = 1, version = version + 1, updated_at = ? "
+                     "WHERE session_id = ? AND status NOT IN ('completed', 'error', 'cancelled')", (now, session_id))
+        row = conn.execute('SELECT status FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        return row['status'] if row else None
+    
+    def cancel_requested(self, session_id):
+        row = self._connect().execute('SELECT cancel_requested FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        return bool(row and row['cancel_requested'])
+    
+    def queue_position(self, session_id):
+        """1-based position among queued sessions (FIFO by creation time), or None if not queued"""
+        row = self._connect().execute(
+            "SELECT COUNT(*) AS ahead FROM sessions WHERE status = 'queued' AND created_at <= "
+            "(SELECT created_at FROM sessions WHERE session_id = ? AND status = 'queued')", (session_id,)).fetchone()
+        return row['ahead'] or None
+    
+    def update(self, session_id, **fields):
+        """Set the given fields and bump the session version (one small write)"""
+        unknown = set(fields) - set(self.FIELDS)
+        if unknown:
+            raise KeyError(f"Unknown session fields: {sorted(unknown)}")
+        if 'summary' in fields and fields['summary'] is not None:
+            fields['summary'] = json.dumps(make_json_serializable(fields['summary']))
+        
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        self._connect().execute(
+            f"UPDATE sessions SET {assignments}, version = version + 1, updated_at = ? WHERE session_id = ?",
+            (*fields.values(), time.time(), session_id))
+    
+    def add_live_result(self, session_id, result, **fields):
+        """Record one recent result row (keeping the last few) together with a progress update"""
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN')
+            conn.execute('INSERT INTO live_results (session_id, seq, result) '
+                         'SELECT ?, COALESCE(MAX(seq), 0) + 1, ? FROM live_results WHERE session_id = ?',
+                         (session_id, json.dumps(make_json_serializable(result)), session_id))
+            conn.execute('DELETE FROM live_results WHERE session_id = ? AND seq <= '
+                         '(SELECT MAX(seq) FROM live_results WHERE session_id = ?) - ?',
+                         (session_id, session_id, self.LIVE_RESULTS_KEPT))
+            conn.execute('UPDATE sessions SET results_count = results_count + 1 WHERE session_id = ?', (session_id,))
+            self.update(session_id, **fields)
+    
+    def live_results_since(self, session_id, after_seq=0):
+        """Recent result rows appended after sequence number after_seq, oldest first, and the last sequence number"""
+        rows = self._connect().execute(
+            'SELECT seq, result FROM live_results WHERE session_id = ? AND seq > ? ORDER BY seq',
+            (session_id, after_seq)).fetchall()
+        last_seq = rows[-1]['seq'] if rows else after_seq
+        return [json.loads(row['result']) for row in rows], last_seq
+    
+    def versions(self, session_ids):
+        """Current version of each of the given sessions (missing sessions are left out)"""
+        session_ids = list(session_ids)
+        placeholders = ', '.join('?' * len(session_ids))
+        rows = self._connect().execute(
+            f"SELECT session_id, version FROM sessions WHERE session_id IN ({placeholders})", session_ids).fetchall()
+        return {row['session_id']: row['version'] for row in rows}
+    
+    def get(self, session_id):
+        """Session fields as a dict, or None if unknown"""
+        row = self._connect().execute('SELECT * FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        if row is None:
+            return None
+        session = dict(row)
+        if session['summary'] is not None:
+            session['summary'] = json.loads(session['summary'])
+        return session
+    
+    def sessions_before(self, cutoff):
+        """IDs of sessions not updated since cutoff (epoch seconds), oldest first"""
+        rows = self._connect().execute(
+            'SELECT session_id FROM sessions WHERE updated_at < ? ORDER BY updated_at', (cutoff,)).fetchall()
+        return [row['session_id'] for row in rows]
+    
+    def queued_sessions(self):
+        """(session_id, owner_pid) of every queued session"""
+        rows = self._connect().execute("SELECT session_id, owner_pid FROM sessions WHERE status = 'queued'").fetchall()
+        return [(row['session_id'], row['owner_pid']) for row in rows]
+    
+    def fail_queued(self, session_id, error):
+        """Mark a session as failed if it is still queued (it never started). Returns True if it was."""
+        cursor = self._connect().execute(
+            "UPDATE sessions SET status = 'error', error = ?, version = version + 1, updated_at = ? "
+            "WHERE session_id = ? AND status = 'queued'", (error, time.time(), session_id))
+        return cursor.rowcount > 0
+    
+    def finished_sessions(self):
+        """IDs of completed/failed/cancelled sessions, least recently updated first"""
+        rows = self._connect().execute(
+            "SELECT session_id FROM sessions WHERE status IN ('completed', 'error', 'cancelled') ORDER BY updated_at").fetchall()
+        return [row['session_id'] for row in rows]
+    
+    def delete(self, session_id):
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN')
+            conn.execute('DELETE FROM live_results WHERE session_id = ?', (session_id,))
+            conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+    
+    def increment_counters(self, **counts):
+        """Add to named monitoring counters (shared by all workers)"""
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN')
+            for name, value in counts.items():
+                if value:
+                    conn.execute('INSERT INTO counters (name, value) VALUES (?, ?) '
+                                 'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value', (name, value))
+    
+    def counters(self):
+        return {row['name']: row['value'] for row in self._connect().execute('SELECT name, value FROM counters')}
+    
+    def __contains__(self, session_id):
+        return self._connect().execute('SELECT 1 FROM sessions WHERE session_id = ?', (session_id,)).fetchone() is not None
+
+# Analysis sessions and their progress - shared across worker processes
+session_store = SessionStore(app.config['SESSION_DB'])
+
+class AnalysisCancelled(Exception):
+    """Raised inside an analysis when it was cancelled or ran past its time limit"""
+
+class CancellationToken:
+    """
+    Checked by a running analysis between blocks and stages. Trips when the session is
+    flagged in the session store (see /cancel) or when the wall-clock deadline passes.
+    """
+    def __init__(self, session_id, timeout_seconds=None):
+        self.session_id = session_id
+        self.deadline = time.monotonic() + timeout_seconds if timeout_seconds else None
+    
+    def check(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise AnalysisCancelled(f"Analysis exceeded the time limit of {app.config['ANALYSIS_TIMEOUT_SECONDS']} seconds")
+        if session_store.cancel_requested(self.session_id):
+            raise AnalysisCancelled('Cancelled by user')
+
+class SessionWatcher:
+    """
+    Wakes progress streams when a session changes. Analyses run in other processes, so one
+    thread per web worker polls the versions of the sessions being watched (a single small
+    query per tick, however many viewers) and notifies a condition variable on any change.
+    """
+    POLL_INTERVAL = 0.2
+    
+    def __init__(self, store):
+        self.store = store
+        self.condition = threading.Condition()
+        self.watchers = {}   # session_id -> number of streams waiting on it
+        self.versions = {}   # session_id -> last seen version
+        self.pid = None
+    
+    def _ensure_thread(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            threading.Thread(target=self._poll, daemon=True).start()
+    
+    def _poll(self):
+        while True:
+            time.sleep(self.POLL_INTERVAL)
+            with self.condition:
+                watched = list(self.watchers)
+            if not watched:
+                continue
+            try:
+                versions = self.store.versions(watched)
+            except sqlite3.Error as e:
+                print(f"Session watcher error: {str(e)}")
+                continue
+            with self.condition:
+                changed = any(self.versions.get(sid) != version for sid, version in versions.items())
+                self.versions.update(versions)
+                if changed:
+                    self.condition.notify_all()
+    
+    def wait_for_change(self, session_id, known_version, timeout):
+        """Block until the session's version differs from known_version or timeout passes"""
+        with self.condition:
+            self._ensure_thread()
+            self.watchers[session_id] = self.watchers.get(session_id, 0) + 1
+            # Versions only grow; never let a not-yet-polled entry look like a change
+            seen = self.versions.get(session_id)
+            if seen is None or (known_version is not None and seen < known_version):
+                self.versions[session_id] = known_version
+            try:
+                return self.condition.wait_for(lambda: self.versions.get(session_id) != known_version, timeout)
+            finally:
+                self.watchers[session_id] -= 1
+                if not self.watchers[session_id]:
+                    del self.watchers[session_id]
+                    self.versions.pop(session_id, None)
+
+session_watcher = SessionWatcher(session_store)
+
+# Results loaded in this process, least recently used first:
+# session_id -> (ColumnarResults, size in bytes, last access time), see get_session_results
+session_results = OrderedDict()
+session_results_lock = threading.Lock()
+
+# Janitor thread of this process, see ensure_janitor
+janitor_pid = None
+janitor_lock = threading.Lock()
+
+# Process pool running the analyses, created lazily in each web worker process
+analysis_executor = None
+analysis_executor_pid = None
+analysis_executor_lock = threading.Lock()
+
+# Registered reference datasets loaded in this process (reference_id -> custom dataset)
+reference_datasets = {}
 
 def make_json_serializable(obj):
     """Convert numpy/pandas types to JSON-serializable Python types"""
@@ -49,6 +424,40 @@ def make_json_serializable(obj):
     else:
         return obj
 
+def json_safe_values(values):
+    """
+    One column as an object array of JSON-safe native values, converted column-wise with
+    the same rules as make_json_serializable: NaN/Inf/missing -> None, NumPy scalars ->
+    int/float, strings without null bytes and surrounding whitespace
+    """
+    array = np.asarray(values)
+    if array.dtype.kind == 'f':
+        out = array.astype(object)
+        out[~np.isfinite(array)] = None
+        return out
+    if array.dtype.kind in 'iub':
+        return array.astype(object)
+    
+    out = np.empty(len(array), dtype=object)
+    out[:] = [value.replace('\x00', '').strip() if type(value) is str else make_json_serializable(value)
+              for value in array]
+    return out
+
+def frame_to_json_records(frame):
+    """DataFrame rows as JSON-safe dicts, converting column by column"""
+    columns = [json_safe_values(frame[col].to_numpy()) for col in frame.columns]
+    return [dict(zip(frame.columns, values)) for values in zip(*columns)]
+
+def dumps_json(obj):
+    """Encode already JSON-safe data to UTF-8 bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def json_response(obj, status=200):
+    """Response for already JSON-safe data (skips jsonify's key sorting and re-encoding)"""
+    return Response(dumps_json(obj), status=status, mimetype='application/json')
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -90,8 +499,283 @@ def haversine_vectorized(lat1, lon1, lat2_array, lon2_array):
     
     return 6371 * c  # Earth radius in kilometers
 
-def read_excel_or_csv(file_path):
-    """Read CSV or Excel file"""
+def haversine_block(lats1, lons1, lats2, lons2):
+    """
+    Blocked haversine kernel using NumPy broadcasting
+    Returns a (len(lats1) x len(lats2)) tile of distances in kilometers
+    """
+    lat1_rad = np.radians(np.asarray(lats1, dtype=np.float64))[:, None]
+    lon1_rad = np.radians(np.asarray(lons1, dtype=np.float64))[:, None]
+    lat2_rad = np.radians(np.asarray(lats2, dtype=np.float64))[None, :]
+    lon2_rad = np.radians(np.asarray(lons2, dtype=np.float64))[None, :]
+    
+    a = np.sin((lat2_rad - lat1_rad) / 2) ** 2
+    a += np.cos(lat1_rad) * np.cos(lat2_rad) * np.sin((lon2_rad - lon1_rad) / 2) ** 2
+    
+    return EARTH_RADIUS_KM * 2 * np.arcsin(np.sqrt(a))
+
+def choose_block_size(n_custom, memory_mb=None):
+    """
+    Number of government schools per distance tile so that a (block x n_custom) tile and
+    its temporaries stay within the memory budget
+    """
+    memory_mb = memory_mb or app.config['DISTANCE_BLOCK_MEMORY_MB']
+    bytes_per_gov_row = max(n_custom, 1) * 8 * TILE_TEMPORARIES
+    return max(1, int(memory_mb * 1024 * 1024 // bytes_per_gov_row))
+
+def nearest_k(query_idx, point_idx, distances, k):
+    """
+    Keep the k nearest of the candidate (query_idx, point_idx, distance) triples per query point.
+    Returns them ordered by query, then distance, then point index
+    """
+    order = np.lexsort((point_idx, distances, query_idx))
+    query_idx, point_idx, distances = query_idx[order], point_idx[order], distances[order]
+    # Rank within each query's run of candidates
+    run_starts = np.flatnonzero(np.r_[True, query_idx[1:] != query_idx[:-1]]) if len(query_idx) else np.array([], dtype=np.int64)
+    run_lengths = np.diff(np.r_[run_starts, len(query_idx)])
+    rank = np.arange(len(query_idx)) - np.repeat(run_starts, run_lengths)
+    keep = rank < k
+    return query_idx[keep], point_idx[keep], distances[keep]
+
+def knn_brute_block(lats, lons, point_lats, point_lons, k):
+    """
+    k nearest points for every query point by full distance tiles, in blocks that fit
+    the tile memory budget. Returns (query_idx, point_idx, distances) like nearest_k()
+    """
+    parts = []
+    k = min(k, len(point_lats))
+    block_size = choose_block_size(len(point_lats))
+    for block_start in range(0, len(lats) if k else 0, block_size):
+        tile = haversine_block(lats[block_start:block_start + block_size], lons[block_start:block_start + block_size],
+                               point_lats, point_lons)
+        # Every point up to each row's k-th smallest distance - ties included, so nearest_k()
+        # breaks them by point index rather than argpartition picking one arbitrarily
+        kth_distance = np.partition(tile, k - 1, axis=1)[:, k - 1]
+        query_idx, point_idx = np.nonzero(tile <= kth_distance[:, None])
+        parts.append((query_idx + block_start, point_idx, tile[query_idx, point_idx]))
+    if not parts:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+    return nearest_k(*(np.concatenate(column) for column in zip(*parts)), k)
+
+class BruteForceIndex:
+    """
+    Fallback spatial index - compares the query points against every custom school.
+    Same interface as GridSpatialIndex so the two can be switched freely.
+    """
+    def __init__(self, lats, lons):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+
+    def query_block(self, lats, lons, radius_km):
+        """
+        Return (query_idx, point_idx, distances) triples within radius_km for a block of
+        query points, ordered by query then point index
+        """
+        tile = haversine_block(lats, lons, self.lats, self.lons)
+        query_idx, point_idx = np.nonzero(tile <= radius_km)
+        return query_idx, point_idx, tile[query_idx, point_idx]
+
+    def query_knn_block(self, lats, lons, k):
+        """
+        Return (query_idx, point_idx, distances) of the k nearest points to each query point,
+        regardless of distance, ordered by query, then distance, then point index
+        """
+        return knn_brute_block(np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64),
+                               self.lats, self.lons, k)
+
+class GridSpatialIndex:
+    """
+    Uniform lat/lon grid over the custom schools.
+    Points are bucketed into cells of roughly cell_km x cell_km and stored sorted by
+    cell key, so a radius query only looks at the cells overlapping the search box
+    and computes exact haversine distances for those candidates.
+    """
+    def __init__(self, lats, lons, cell_km=SEARCH_RADIUS_KM):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.lat_step = cell_km / KM_PER_DEGREE
+
+        # Size longitude cells for the widest latitude so cells are never narrower than cell_km
+        max_abs_lat = min(np.abs(self.lats).max(), 89.0) if len(self.lats) else 0.0
+        self.lon_step = cell_km / (KM_PER_DEGREE * np.cos(np.radians(max_abs_lat)))
+
+        if len(self.lats) == 0:
+            self.order = np.array([], dtype=np.int64)
+            self.sorted_keys = np.array([], dtype=np.int64)
+            return
+
+        cell_rows = np.floor(self.lats / self.lat_step).astype(np.int64)
+        cell_cols = np.floor(self.lons / self.lon_step).astype(np.int64)
+        self.row_min, self.row_max = cell_rows.min(), cell_rows.max()
+        self.col_min, self.col_max = cell_cols.min(), cell_cols.max()
+        self.width = self.col_max - self.col_min + 1
+
+        keys = (cell_rows - self.row_min) * self.width + (cell_cols - self.col_min)
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+    def _search_span(self, lat, radius_km):
+        """Number of cells to search on each side of the query cell (rows, cols)"""
+        radius_lat_deg = radius_km / KM_PER_DEGREE
+        # Longitude degrees shrink towards the poles - use the highest latitude the circle reaches
+        reach_lat = min(abs(lat) + radius_lat_deg, 89.0)
+        radius_lon_deg = radius_km / (KM_PER_DEGREE * np.cos(np.radians(reach_lat)))
+        return int(np.ceil(radius_lat_deg / self.lat_step)), int(np.ceil(radius_lon_deg / self.lon_step))
+
+    def query_block(self, lats, lons, radius_km):
+        """
+        Return (query_idx, point_idx, distances) triples within radius_km for a block of
+        query points, ordered by query then point index
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        empty = (np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.float64))
+        if len(self.sorted_keys) == 0 or len(lats) == 0:
+            return empty
+        
+        # One search span for the whole block, sized for its highest latitude
+        span_rows, span_cols = self._search_span(np.abs(lats).max(), radius_km)
+        query_rows = np.floor(lats / self.lat_step).astype(np.int64)
+        query_cols = np.floor(lons / self.lon_step).astype(np.int64)
+        col_lo = np.maximum(query_cols - span_cols, self.col_min) - self.col_min
+        col_hi = np.minimum(query_cols + span_cols, self.col_max) - self.col_min
+        query_positions = np.arange(len(lats))
+        
+        # Each (query point, grid row) pair maps to one contiguous run of the sorted keys
+        run_queries, run_starts, run_ends = [], [], []
+        for row_offset in range(-span_rows, span_rows + 1):
+            rows = query_rows + row_offset
+            ok = (rows >= self.row_min) & (rows <= self.row_max) & (col_lo <= col_hi)
+            if not ok.any():
+                continue
+            row_base = (rows[ok] - self.row_min) * self.width
+            run_queries.append(query_positions[ok])
+            run_starts.append(np.searchsorted(self.sorted_keys, row_base + col_lo[ok], side='left'))
+            run_ends.append(np.searchsorted(self.sorted_keys, row_base + col_hi[ok], side='right'))
+        if not run_queries:
+            return empty
+        
+        run_queries = np.concatenate(run_queries)
+        run_starts = np.concatenate(run_starts)
+        run_lengths = np.concatenate(run_ends) - run_starts
+        total = int(run_lengths.sum())
+        if total == 0:
+            return empty
+        
+        # Expand the runs into flat (query, candidate) pairs
+        run_offsets = np.cumsum(run_lengths) - run_lengths
+        positions = np.arange(total) - np.repeat(run_offsets - run_starts, run_lengths)
+        query_idx = np.repeat(run_queries, run_lengths)
+        point_idx = self.order[positions]
+        
+        # Exact haversine as the final filter
+        distances = haversine_vectorized(lats[query_idx], lons[query_idx], self.lats[point_idx], self.lons[point_idx])
+        mask = distances <= radius_km
+        query_idx, point_idx, distances = query_idx[mask], point_idx[mask], distances[mask]
+        
+        order = np.lexsort((point_idx, query_idx))
+        return query_idx[order], point_idx[order], distances[order]
+
+    def query_knn_block(self, lats, lons, k):
+        """
+        Return (query_idx, point_idx, distances) of the k nearest points to each query point,
+        regardless of distance, ordered by query, then distance, then point index.
+        Expanding search: radius queries starting at one cell, doubling the radius for the
+        query points that still have fewer than k candidates. A radius query returns every
+        point within the radius, so once a query point has k candidates they are its k nearest.
+        When the search box would cover the whole grid the remaining points are brute-forced.
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        k = min(k, len(self.lats))
+        if k == 0 or len(lats) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+        grid_rows = self.row_max - self.row_min + 1
+        parts = []
+        pending = np.arange(len(lats))
+        radius_km = self.lat_step * KM_PER_DEGREE
+        while len(pending):
+            span_rows, span_cols = self._search_span(np.abs(lats[pending]).max(), radius_km)
+            if 2 * span_rows + 1 >= grid_rows and 2 * span_cols + 1 >= self.width:
+                query_idx, point_idx, distances = knn_brute_block(lats[pending], lons[pending], self.lats, self.lons, k)
+                parts.append((pending[query_idx], point_idx, distances))
+                break
+
+            query_idx, point_idx, distances = self.query_block(lats[pending], lons[pending], radius_km)
+            done = np.bincount(query_idx, minlength=len(pending)) >= k
+            keep = done[query_idx]
+            parts.append((pending[query_idx[keep]], point_idx[keep], distances[keep]))
+            pending = pending[~done]
+            radius_km *= 2
+
+        return nearest_k(*(np.concatenate(column) for column in zip(*parts)), k)
+
+SPATIAL_INDEX_TYPES = {
+    'grid': GridSpatialIndex,
+    'brute': BruteForceIndex
+}
+
+def build_spatial_index(lats, lons, index_type=None):
+    """Build the configured spatial index over custom school coordinates"""
+    index_type = index_type or app.config['SPATIAL_INDEX']
+    if index_type not in SPATIAL_INDEX_TYPES:
+        raise ValueError(f"Unknown spatial index '{index_type}'. Available: {list(SPATIAL_INDEX_TYPES)}")
+    return SPATIAL_INDEX_TYPES[index_type](lats, lons)
+
+def share_custom_arrays(spatial_index, index_type, valid_indices):
+    """
+    Copy the spatial index arrays and valid_indices into shared memory, so partition
+    workers attach to them instead of receiving a pickled copy with every chunk.
+    Returns (segments, spec) - the caller must close and unlink the segments when done;
+    spec is the small picklable description the workers attach with.
+    """
+    state = dict(spatial_index_state(spatial_index), _valid_indices=valid_indices)
+    segments = []
+    spec = {'index_type': index_type, 'arrays': {}, 'scalars': {}}
+    for name, value in state.items():
+        if not isinstance(value, np.ndarray):
+            spec['scalars'][name] = value
+            continue
+        segment = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+        np.ndarray(value.shape, dtype=value.dtype, buffer=segment.buf)[...] = value
+        segments.append(segment)
+        spec['arrays'][name] = (segment.name, value.shape, value.dtype.str)
+    return segments, spec
+
+# Shared custom arrays attached in this (partition worker) process: segment names -> (segments, index, valid_indices)
+attached_custom_arrays = {}
+
+def attach_custom_arrays(spec):
+    """Spatial index and valid_indices as views on the shared memory described by spec"""
+    key = tuple(sorted(name for name, _, _ in spec['arrays'].values()))
+    if key not in attached_custom_arrays:
+        segments = []
+        state = dict(spec['scalars'])
+        for name, (segment_name, shape, dtype) in spec['arrays'].items():
+            segment = shared_memory.SharedMemory(name=segment_name)
+            segments.append(segment)
+            state[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf)
+        valid_indices = state.pop('_valid_indices')
+        
+        # Only the current analysis' segments stay mapped
+        for old_key in list(attached_custom_arrays):
+            for segment in attached_custom_arrays.pop(old_key)[0]:
+                segment.close()
+        attached_custom_arrays[key] = (segments, restore_spatial_index(spec['index_type'], state), valid_indices)
+    _, spatial_index, valid_indices = attached_custom_arrays[key]
+    return spatial_index, valid_indices
+
+def hash_file(file_path):
+    """SHA-256 of a file's content"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def parse_excel_or_csv(file_path):
+    """Parse CSV or Excel file"""
     try:
         if file_path.endswith('.csv'):
             return pd.read_csv(file_path, encoding='utf-8')
@@ -100,14 +784,216 @@ def read_excel_or_csv(file_path):
     except UnicodeDecodeError:
         return pd.read_csv(file_path, encoding='latin-1')
 
-def clean_coordinate(coord):
-    """Clean and convert coordinate to float"""
-    if pd.isna(coord):
-        return None
+def evict_parsed_cache():
+    """Drop least recently used parsed files until the cache fits PARSED_CACHE_MAX_MB"""
+    cache_dir = app.config['PARSED_CACHE_FOLDER']
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    
+    budget = app.config['PARSED_CACHE_MAX_MB'] * 1024 * 1024
+    used = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if used <= budget:
+            break
+        try:
+            os.remove(path)
+            print(f"🗑️ Evicted parsed file cache entry {os.path.basename(path)}")
+        except FileNotFoundError:
+            pass
+        used -= size
+
+def read_excel_or_csv(file_path, file_hash=None):
+    """
+    Read CSV or Excel file
+    Parsed DataFrames are cached by content hash under PARSED_CACHE_FOLDER, so
+    re-uploading an identical file skips the (slow) Excel/CSV parsing.
+    """
+    cache_dir = app.config['PARSED_CACHE_FOLDER']
+    extension = os.path.splitext(file_path)[1].lower().lstrip('.')
+    cache_path = os.path.join(cache_dir, f"{file_hash or hash_file(file_path)}.{extension}.pkl")
+    
     try:
-        return float(str(coord).strip())
-    except:
-        return None
+        df = pd.read_pickle(cache_path)
+        os.utime(cache_path)  # Mark as recently used
+        print(f"⚡ Parsed file cache hit for {os.path.basename(file_path)}")
+        return df
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        # Truncated, or pickled by another pandas/Python version - drop the entry and parse again
+        print(f"⚠️ Unreadable parsed file cache entry {os.path.basename(cache_path)}: {str(e)}")
+        try:
+            os.remove(cache_path)
+        except FileNotFoundError:
+            pass
+    
+    df = parse_excel_or_csv(file_path)
+    
+    # Write to a temporary name first so concurrent readers never see a partial file
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+    df.to_pickle(tmp_path)
+    os.replace(tmp_path, cache_path)
+    evict_parsed_cache()
+    return df
+
+# Coordinate rejection reason codes (one per row, see clean_coordinates)
+COORD_OK = 0
+COORD_MISSING = 1
+COORD_NOT_NUMERIC = 2
+COORD_LAT_OUT_OF_RANGE = 3
+COORD_LON_OUT_OF_RANGE = 4
+COORD_OUTSIDE_REGION = 5  # Valid coordinate outside the Balochistan bounding box - flagged, still analysed
+
+COORD_REASON_LABELS = {
+    COORD_OK: 'ok',
+    COORD_MISSING: 'missing',
+    COORD_NOT_NUMERIC: 'not numeric',
+    COORD_LAT_OUT_OF_RANGE: 'latitude outside ±90',
+    COORD_LON_OUT_OF_RANGE: 'longitude outside ±180',
+    COORD_OUTSIDE_REGION: 'outside Balochistan'
+}
+
+# Sanity-check bounding box for Balochistan (degrees)
+REGION_BOUNDS = {'lat_min': 24.0, 'lat_max': 32.5, 'lon_min': 60.0, 'lon_max': 71.0}
+
+def clean_coordinate_values(values):
+    """
+    Vectorized coordinate parsing for one column.
+    Returns (float64 array with NaN where unusable, reason code array)
+    """
+    series = pd.Series(values, copy=False)
+    missing = series.isna().to_numpy()
+    coords = pd.to_numeric(series, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    
+    # Booleans are not coordinates - to_numeric would turn True/False into 1.0/0.0
+    if pd.api.types.is_bool_dtype(series.dtype):
+        coords[:] = np.nan
+    elif series.dtype == object:
+        maybe_bool = np.flatnonzero((coords == 0) | (coords == 1))
+        if len(maybe_bool):
+            is_bool = series.iloc[maybe_bool].map(lambda v: isinstance(v, (bool, np.bool_))).to_numpy(dtype=bool)
+            coords[maybe_bool[is_bool]] = np.nan
+    
+    # Second pass only for text cells that did not parse: non-breaking spaces, unicode minus, degree signs.
+    # Other cell types (dates and times from date-formatted Excel cells) stay 'not numeric'.
+    retry = np.flatnonzero(np.isnan(coords) & ~missing)
+    if series.dtype == object and len(retry):
+        retry = retry[series.iloc[retry].map(lambda v: isinstance(v, str)).to_numpy(dtype=bool)]
+    if series.dtype == object and len(retry):
+        text = (series.iloc[retry].str.replace('\u00a0', ' ', regex=False)
+                                  .str.replace('\u2212', '-', regex=False)
+                                  .str.replace('°', '', regex=False)
+                                  .str.strip())
+        missing[retry] = (text == '').to_numpy()
+        coords[retry] = pd.to_numeric(text, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    
+    reasons = np.full(len(coords), COORD_OK, dtype=np.int8)
+    reasons[np.isnan(coords)] = COORD_NOT_NUMERIC
+    reasons[missing] = COORD_MISSING
+    coords[reasons != COORD_OK] = np.nan
+    return coords, reasons
+
+def validate_coordinates(lats, lons, lat_reasons, lon_reasons):
+    """
+    Combine per-column reasons, range-check lat/lon and flag points outside the region.
+    Returns (lats, lons, reasons) with NaN coordinates for every rejected row.
+    """
+    reasons = np.where(lat_reasons != COORD_OK, lat_reasons, lon_reasons).astype(np.int8)
+    
+    with np.errstate(invalid='ignore'):
+        reasons[(reasons == COORD_OK) & ~(np.abs(lats) <= 90)] = COORD_LAT_OUT_OF_RANGE
+        reasons[(reasons == COORD_OK) & ~(np.abs(lons) <= 180)] = COORD_LON_OUT_OF_RANGE
+    reasons[(reasons == COORD_OK) & ~in_region(lats, lons)] = COORD_OUTSIDE_REGION
+    
+    rejected = ~np.isin(reasons, [COORD_OK, COORD_OUTSIDE_REGION])
+    lats = np.where(rejected, np.nan, lats)
+    lons = np.where(rejected, np.nan, lons)
+    return lats, lons, reasons
+
+def clean_coordinates(lat_values, lon_values):
+    """Clean and validate a lat/lon column pair. Returns (lats, lons, reasons)"""
+    lats, lat_reasons = clean_coordinate_values(lat_values)
+    lons, lon_reasons = clean_coordinate_values(lon_values)
+    return validate_coordinates(lats, lons, lat_reasons, lon_reasons)
+
+def coordinate_reason_counts(reasons):
+    """Count rows per rejection reason label (only reasons that occur)"""
+    codes, counts = np.unique(reasons, return_counts=True)
+    return {COORD_REASON_LABELS[int(code)]: int(count) for code, count in zip(codes, counts)}
+
+def in_region(lats, lons):
+    """Boolean mask of points inside REGION_BOUNDS"""
+    with np.errstate(invalid='ignore'):
+        return ((lats >= REGION_BOUNDS['lat_min']) & (lats <= REGION_BOUNDS['lat_max']) &
+                (lons >= REGION_BOUNDS['lon_min']) & (lons <= REGION_BOUNDS['lon_max']))
+
+def detect_swapped_coordinates(lats, lons, sources):
+    """
+    Decide per row whether the lat/lon pair is swapped.
+    A row is swapped when only the flipped pair falls inside the expected region.
+    Rows that fit neither orientation (e.g. 0,0 or typos) follow the majority
+    decision of their source, so a source that is swapped as a whole stays consistent.
+    Returns (swap_mask, swaps_by_source)
+    """
+    as_is = in_region(lats, lons)
+    flipped = in_region(lons, lats)
+    swap_mask = flipped & ~as_is
+    
+    undecided = ~as_is & ~flipped & ~np.isnan(lats) & ~np.isnan(lons)
+    if undecided.any():
+        decided = pd.DataFrame({'source': sources, 'swap': swap_mask})[~undecided]
+        swapped_share = decided.groupby('source', dropna=False)['swap'].mean()
+        majority_swapped = pd.Series(sources).map(swapped_share > 0.5).fillna(False).to_numpy(dtype=bool)
+        swap_mask = swap_mask | (undecided & majority_swapped)
+    
+    swaps_by_source = pd.Series(sources)[swap_mask].value_counts(dropna=False).to_dict()
+    return swap_mask, swaps_by_source
+
+def prepare_custom_dataset(special_df, special_mapping):
+    """
+    Prepare the custom schools (BEAC/NCHD/BEF) once per analysis.
+    Cleans the coordinate columns, detects and fixes swapped lat/lon pairs and returns
+    float64 coordinate arrays (NaN where invalid), a validity mask, per-row rejection
+    reason codes and the source array.
+    """
+    source_col = special_mapping.get('source')
+    
+    lats_raw, lat_reasons = clean_coordinate_values(special_df[special_mapping['latitude']])
+    lons_raw, lon_reasons = clean_coordinate_values(special_df[special_mapping['longitude']])
+    
+    if source_col:
+        sources = special_df[source_col].to_numpy(dtype=object)
+    else:
+        sources = np.full(len(special_df), 'N/A', dtype=object)
+    
+    # Some sources (historically BEAC and NCHD) store latitude in the longitude column
+    swap_mask, swaps_by_source = detect_swapped_coordinates(lats_raw, lons_raw, sources)
+    lats = np.where(swap_mask, lons_raw, lats_raw)
+    lons = np.where(swap_mask, lats_raw, lons_raw)
+    
+    # Range and region checks apply to the corrected orientation
+    lats, lons, reasons = validate_coordinates(lats, lons,
+                                               np.where(swap_mask, lon_reasons, lat_reasons),
+                                               np.where(swap_mask, lat_reasons, lon_reasons))
+    valid_mask = ~(np.isnan(lats) | np.isnan(lons))
+    
+    return {
+        'lats': lats,
+        'lons': lons,
+        'valid_mask': valid_mask,
+        'valid_indices': np.flatnonzero(valid_mask),
+        'reasons': reasons,
+        'sources': sources,
+        'swapped_count': int(swap_mask.sum()),
+        'swaps_by_source': swaps_by_source
+    }
 
 def get_column_mapping(df, data_type='unknown'):
     """Get flexible column mapping for different data formats"""
@@ -171,26 +1057,623 @@ def get_column_mapping(df, data_type='unknown'):
     
     return mapping
 
-def analyze_distances(gov_df, special_df, session_id=None, progress_callback=None):
+# Result row schema: result key -> column mapping field
+GOV_RESULT_FIELDS = [
+    ('gov_school_name', 'school_name'),
+    ('gov_bemis_code', 'bemis_code'),
+    ('gov_district', 'district'),
+    ('gov_tehsil', 'tehsil'),
+    ('gov_uc', 'uc'),
+    ('gov_level', 'level'),
+    ('gov_gender', 'gender'),
+    ('gov_enrollment', 'enrollment'),
+    ('gov_space_for_rooms', 'space_for_rooms'),
+    ('gov_total_rooms', 'total_rooms'),
+    ('gov_toilets', 'toilets'),
+    ('gov_boundary_wall', 'boundary_wall'),
+    ('gov_drinking_water', 'drinking_water')
+]
+
+CUSTOM_RESULT_FIELDS = [
+    ('custom_school_name', 'school_name'),
+    ('custom_bemis_code', 'bemis_code'),
+    ('custom_division', 'division'),
+    ('custom_district', 'district'),
+    ('custom_tehsil', 'tehsil'),
+    ('custom_level', 'level'),
+    ('custom_gender', 'gender'),
+    ('custom_students', 'enrollment'),
+    ('custom_functional_status', 'functional_status'),
+    ('custom_source', 'source')
+]
+
+# Full result row schema, in output order
+RESULT_COLUMNS = ([key for key, _ in GOV_RESULT_FIELDS] + ['gov_latitude', 'gov_longitude'] +
+                  [key for key, _ in CUSTOM_RESULT_FIELDS] +
+                  ['distance_km', 'custom_latitude', 'custom_longitude', 'custom_schools_count', 'ring'])
+# Result columns computed per match rather than taken from the school attribute tables
+MATCH_COLUMNS = ('distance_km', 'custom_schools_count', 'ring')
+
+def ring_labels(rings):
+    """Labels of the distance rings for boundaries like (2, 5, 10): '0-2km', '2-5km', '5-10km', '10+km'"""
+    edges = [0.0] + list(rings)
+    return [f"{low:g}-{high:g}km" for low, high in zip(edges, edges[1:])] + [f"{edges[-1]:g}+km"]
+
+def default_rings(radius_km=None):
+    """DEFAULT_RINGS_KM cut off at the search radius, which becomes the outermost ring (all of them when radius_km is None)"""
+    if radius_km is None:
+        return DEFAULT_RINGS_KM
+    return tuple(ring for ring in DEFAULT_RINGS_KM if ring < radius_km) + (float(radius_km),)
+
+def ring_index(distances, rings):
+    """Ring number of each distance; a distance on a boundary belongs to the inner ring"""
+    return np.searchsorted(np.asarray(rings, dtype=np.float64), distances, side='left')
+
+def build_attribute_frame(df, mapping, fields, lats, lons, prefix):
+    """
+    Build the per-school attribute table once, with result column names
+    (e.g. 'gov_school_name') instead of the uploaded file's column names.
+    Unmapped fields are filled with 'N/A'.
+    """
+    columns = {}
+    for key, field in fields:
+        col = mapping.get(field)
+        if col is not None and col in df.columns:
+            columns[key] = df[col].to_numpy()
+        else:
+            columns[key] = np.full(len(df), 'N/A', dtype=object)
+    
+    frame = pd.DataFrame(columns)
+    frame[f'{prefix}_latitude'] = lats
+    frame[f'{prefix}_longitude'] = lons
+    return frame
+
+def build_gov_attribute_frame(gov_df, gov_mapping, gov_lats, gov_lons):
+    """Government school attribute table, with blank/'N/A' enrollment normalised to 'N/A'"""
+    frame = build_attribute_frame(gov_df, gov_mapping, GOV_RESULT_FIELDS, gov_lats, gov_lons, 'gov')
+    enrollment = frame['gov_enrollment']
+    missing = enrollment.isna() | (enrollment.astype(str).str.strip().str.upper() == 'N/A')
+    if missing.any():
+        frame['gov_enrollment'] = enrollment.astype(object).where(~missing, 'N/A')
+    return frame
+
+def build_custom_attribute_frame(special_df, special_mapping, custom_lats, custom_lons):
+    """Custom school attribute table, with the corrected (swapped) coordinates"""
+    return build_attribute_frame(special_df, special_mapping, CUSTOM_RESULT_FIELDS, custom_lats, custom_lons, 'custom')
+
+# Columns searched by the results API 'search' parameter
+RESULT_SEARCH_COLUMNS = ['gov_school_name', 'gov_bemis_code', 'custom_school_name', 'custom_bemis_code']
+
+class ColumnarResults:
+    """
+    Analysis results stored as columns of row references - one entry per gov-to-custom match
+    holding the government row index, the custom row index and the distance.
+    School attributes live once per school in gov_frame / custom_frame and are only joined
+    in (a single index-based take) when rows are exported or serialized.
+    """
+    def __init__(self, gov_frame, custom_frame, radius_km=SEARCH_RADIUS_KM, rings=DEFAULT_RINGS_KM, nearest_k=None):
+        self.gov_frame = gov_frame
+        self.custom_frame = custom_frame
+        self.radius_km = radius_km  # None for nearest-neighbour results
+        self.nearest_k = nearest_k  # k of a nearest-neighbour (knn mode) analysis, None for a radius search
+        self.rings = tuple(rings)  # Ring boundaries (km) matches are labelled with
+        
+        self._blocks = []
+        self._gov_idx = np.array([], dtype=np.int64)
+        self._custom_idx = np.array([], dtype=np.int64)
+        self._distance_km = np.array([], dtype=np.float64)
+        self._custom_schools_count = np.array([], dtype=np.int64)
+        self._json_columns = None  # JSON-safe attribute columns, built on first use
+    
+    def append_block(self, gov_idx, custom_idx, distance_km):
+        """Add matches from one block; rows must already be in final order"""
+        if len(gov_idx):
+            self._blocks.append((np.asarray(gov_idx, dtype=np.int64),
+                                 np.asarray(custom_idx, dtype=np.int64),
+                                 np.asarray(distance_km, dtype=np.float64)))
+    
+    def _consolidate(self):
+        if not self._blocks:
+            return
+        self._gov_idx = np.concatenate([self._gov_idx] + [b[0] for b in self._blocks])
+        self._custom_idx = np.concatenate([self._custom_idx] + [b[1] for b in self._blocks])
+        self._distance_km = np.concatenate([self._distance_km] + [b[2] for b in self._blocks])
+        self._custom_schools_count = np.bincount(self._gov_idx, minlength=len(self.gov_frame))[self._gov_idx]
+        self._blocks = []
+    
+    @property
+    def gov_idx(self):
+        self._consolidate()
+        return self._gov_idx
+    
+    @property
+    def custom_idx(self):
+        self._consolidate()
+        return self._custom_idx
+    
+    @property
+    def distance_km(self):
+        self._consolidate()
+        return self._distance_km
+    
+    @property
+    def custom_schools_count(self):
+        self._consolidate()
+        return self._custom_schools_count
+    
+    def __len__(self):
+        return len(self.gov_idx)
+    
+    def __getitem__(self, key):
+        """Integer index returns one result dict, a slice returns a list of result dicts"""
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("ColumnarResults slices do not support a step")
+            return self.to_records(start, stop)
+        if key < 0:
+            key += len(self)
+        return self.to_records(key, key + 1)[0]
+    
+    def __iter__(self):
+        chunk = 10000
+        for start in range(0, len(self), chunk):
+            yield from self.to_records(start, start + chunk)
+    
+    def column(self, key):
+        """Values of one result column for every match, as a NumPy array"""
+        if key == 'distance_km':
+            return self.distance_km
+        if key == 'custom_schools_count':
+            return self.custom_schools_count
+        if key == 'ring':
+            return self.ring_column()
+        if key in self.gov_frame.columns:
+            return self.gov_frame[key].to_numpy()[self.gov_idx]
+        if key in self.custom_frame.columns:
+            return self.custom_frame[key].to_numpy()[self.custom_idx]
+        raise KeyError(key)
+    
+    def ring_column(self, rows=slice(None)):
+        """Ring label of each match (or of the matches at rows)"""
+        labels = np.array(ring_labels(self.rings), dtype=object)
+        return labels[ring_index(self.distance_km[rows], self.rings)]
+    
+    def to_frame(self, start=0, stop=None, positions=None):
+        """
+        Join attribute columns for matches [start:stop] - or the matches at the given
+        positions - into a DataFrame in RESULT_COLUMNS order
+        """
+        rows = slice(start, stop) if positions is None else positions
+        frame = pd.concat([
+            self.gov_frame.take(self.gov_idx[rows]).reset_index(drop=True),
+            self.custom_frame.take(self.custom_idx[rows]).reset_index(drop=True)
+        ], axis=1)
+        frame['distance_km'] = self.distance_km[rows]
+        frame['custom_schools_count'] = self.custom_schools_count[rows]
+        frame['ring'] = self.ring_column(rows)
+        return frame[RESULT_COLUMNS]
+    
+    def block_last_record(self, gov_idx, custom_idx, distance_km):
+        """
+        Result dict of the last match of one block, built from the block's own arrays so the
+        collected blocks are not consolidated (used for live progress). A government school's
+        matches never span blocks, so its custom_schools_count is counted within the block.
+        """
+        gov_row, custom_row, distance = gov_idx[-1], custom_idx[-1], distance_km[-1]
+        record = {**self.gov_frame.iloc[gov_row].to_dict(), **self.custom_frame.iloc[custom_row].to_dict()}
+        record['distance_km'] = float(distance)
+        record['custom_schools_count'] = int(np.count_nonzero(gov_idx == gov_row))
+        record['ring'] = ring_labels(self.rings)[int(ring_index(distance, self.rings))]
+        return {col: record[col] for col in RESULT_COLUMNS}
+    
+    def to_records(self, start=0, stop=None, positions=None):
+        """Join attribute columns for matches [start:stop] (or at positions) and return result dicts"""
+        frame = self.to_frame(start, stop, positions)
+        # Column-wise tolist() is much faster than DataFrame.to_dict('records') and yields native types
+        columns = [frame[col].tolist() for col in RESULT_COLUMNS]
+        return [dict(zip(RESULT_COLUMNS, values)) for values in zip(*columns)]
+    
+    def json_columns(self):
+        """
+        JSON-safe values of every result attribute column, converted once per school and
+        kept for later requests (see json_safe_values)
+        """
+        if self._json_columns is None:
+            self._json_columns = {
+                **{col: json_safe_values(self.gov_frame[col].to_numpy()) for col in self.gov_frame.columns},
+                **{col: json_safe_values(self.custom_frame[col].to_numpy()) for col in self.custom_frame.columns}
+            }
+        return self._json_columns
+    
+    def to_json_records(self, start=0, stop=None, positions=None):
+        """
+        Result dicts for matches [start:stop] (or at positions) that are already JSON-safe -
+        the equivalent of make_json_serializable(to_records(...)) without the per-value walk
+        """
+        columns = self.json_column_block(start, stop, positions)
+        return [dict(zip(RESULT_COLUMNS, values)) for values in zip(*columns)]
+    
+    def json_column_block(self, start=0, stop=None, positions=None):
+        """JSON-safe value arrays of every result column (RESULT_COLUMNS order) for matches [start:stop] or at positions"""
+        rows = slice(start, stop) if positions is None else positions
+        converted = self.json_columns()
+        gov_rows, custom_rows = self.gov_idx[rows], self.custom_idx[rows]
+        columns = []
+        for col in RESULT_COLUMNS:
+            if col in self.gov_frame.columns:
+                columns.append(converted[col][gov_rows])
+            elif col in self.custom_frame.columns:
+                columns.append(converted[col][custom_rows])
+            elif col == 'ring':
+                columns.append(self.ring_column(rows))
+            else:
+                columns.append(json_safe_values(self.column(col)[rows]))
+        return columns
+    
+    def to_state(self):
+        """Plain dict of frames and index arrays (for storing results on disk)"""
+        return {
+            'gov_frame': self.gov_frame,
+            'custom_frame': self.custom_frame,
+            'gov_idx': self.gov_idx,
+            'custom_idx': self.custom_idx,
+            'distance_km': self.distance_km,
+            'radius_km': self.radius_km,
+            'rings': self.rings,
+            'nearest_k': self.nearest_k
+        }
+    
+    def _school_values(self, key):
+        """
+        Values of a result column once per school plus the per-match index into them,
+        so filters and sort keys are computed per school rather than per match
+        """
+        if key in self.gov_frame.columns:
+            return self.gov_frame[key].to_numpy(), self.gov_idx
+        if key in self.custom_frame.columns:
+            return self.custom_frame[key].to_numpy(), self.custom_idx
+        if key in MATCH_COLUMNS:
+            values = self.column(key)
+            return values, np.arange(len(values))
+        raise KeyError(key)
+    
+    def filter_positions(self, equals=None, search=None, min_distance=None, max_distance=None):
+        """
+        Positions of the matches passing all filters, in result order
+        equals maps result columns to accepted values (compared as text), search is a
+        case-insensitive substring looked up in RESULT_SEARCH_COLUMNS
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for key, accepted in (equals or {}).items():
+            values, idx = self._school_values(key)
+            school_mask = pd.Series(values, dtype=object).astype(str).isin([str(value) for value in accepted]).to_numpy()
+            mask &= school_mask[idx]
+        
+        if search:
+            found = np.zeros(len(self), dtype=bool)
+            for key in RESULT_SEARCH_COLUMNS:
+                values, idx = self._school_values(key)
+                school_mask = pd.Series(values, dtype=object).astype(str).str.contains(search, case=False, regex=False).to_numpy()
+                found |= school_mask[idx]
+            mask &= found
+        
+        if min_distance is not None:
+            mask &= self.distance_km >= min_distance
+        if max_distance is not None:
+            mask &= self.distance_km <= max_distance
+        return np.flatnonzero(mask)
+    
+    def sort_positions(self, positions, key, descending=False):
+        """
+        Reorder positions by a result column. Numeric columns sort numerically, others as
+        case-insensitive text; missing/'N/A' values go last and ties keep result order.
+        """
+        values, idx = self._school_values(key)
+        series = pd.Series(values, dtype=object)
+        missing = (series.isna() | (series.astype(str) == 'N/A')).to_numpy()
+        numeric = pd.to_numeric(series.where(~missing), errors='coerce')
+        if numeric[~missing].notna().all():
+            ranks = np.unique(numeric.fillna(0).to_numpy(dtype=np.float64), return_inverse=True)[1]
+        else:
+            ranks = np.unique(series.astype(str).str.lower().to_numpy(dtype=str), return_inverse=True)[1]
+        
+        ranks = ranks.astype(np.int64)
+        school_keys = np.where(missing, ranks.max(initial=0) + 1, -ranks if descending else ranks)
+        if descending:
+            school_keys[missing] = 1  # Above every negated rank, so still last
+        return positions[np.lexsort((positions, school_keys[idx][positions]))]
+    
+    def map_points(self):
+        """Unique government and custom school locations in the results (first match of each)"""
+        gov_rows = self.gov_frame.take(np.unique(self.gov_idx))
+        custom_rows = self.custom_frame.take(np.unique(self.custom_idx))
+        
+        def located(frame, lat_col, lon_col):
+            lats = pd.to_numeric(frame[lat_col], errors='coerce')
+            lons = pd.to_numeric(frame[lon_col], errors='coerce')
+            frame = frame[lats.notna() & lons.notna()]
+            return frame.drop_duplicates(subset=[lat_col, lon_col])
+        
+        return {
+            'gov': located(gov_rows, 'gov_latitude', 'gov_longitude'),
+            'custom': located(custom_rows, 'custom_latitude', 'custom_longitude')
+        }
+    
+    def memory_usage(self):
+        """Approximate bytes held: index arrays plus both attribute frames"""
+        arrays = self.gov_idx.nbytes + self.custom_idx.nbytes + self.distance_km.nbytes + self.custom_schools_count.nbytes
+        frames = self.gov_frame.memory_usage(deep=True).sum() + self.custom_frame.memory_usage(deep=True).sum()
+        return int(arrays + frames)
+    
+    @classmethod
+    def from_state(cls, state):
+        """Results from to_state(); the index arrays are used as they are (e.g. memory-mapped), not copied"""
+        results = cls(state['gov_frame'], state['custom_frame'],
+                      state.get('radius_km', SEARCH_RADIUS_KM), state.get('rings', DEFAULT_RINGS_KM),
+                      state.get('nearest_k'))
+        results._gov_idx = np.asarray(state['gov_idx'], dtype=np.int64)
+        results._custom_idx = np.asarray(state['custom_idx'], dtype=np.int64)
+        results._distance_km = np.asarray(state['distance_km'], dtype=np.float64)
+        results._custom_schools_count = np.bincount(results._gov_idx, minlength=len(results.gov_frame))[results._gov_idx]
+        return results
+
+MATCH_ARRAYS = ('gov_idx', 'custom_idx', 'distance_km')
+
+def results_arrays_path(state_path):
+    """Arrow file with the match arrays stored next to a results state file (results.pkl -> results.arrow)"""
+    return os.path.splitext(state_path)[0] + '.arrow'
+
+def write_results_state(results, summary, state_path):
     """
-    For each government school, find ALL custom schools (BEAC/NCHD/BEF) within 5km
-    Returns detailed analysis with multiple rows per government school
+    Store results for reloading: the per-match arrays as an uncompressed Arrow IPC file, so
+    reloads memory-map them instead of reading them into memory, and the per-school frames
+    and the summary pickled. Without pyarrow everything goes into the pickle.
+    """
+    state = results.to_state()
+    if pa is not None:
+        table = pa.table({name: state.pop(name) for name in MATCH_ARRAYS})
+        with pa.OSFile(results_arrays_path(state_path), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    pd.to_pickle({'results': state, 'summary': summary}, state_path)
+
+def read_results_state(state_path):
+    """(ColumnarResults, summary) stored by write_results_state"""
+    state = pd.read_pickle(state_path)
+    if 'gov_idx' not in state['results']:
+        table = pa.ipc.open_file(pa.memory_map(results_arrays_path(state_path), 'r')).read_all()
+        for name in MATCH_ARRAYS:
+            state['results'][name] = table.column(name).to_numpy()
+    return ColumnarResults.from_state(state['results']), state['summary']
+
+def build_custom_dataset(special_df, index_type=None):
+    """
+    Everything the analysis needs from a custom schools (BEAC/NCHD/BEF) file, computed once:
+    column mapping, prepared coordinates, the attribute table and the spatial index.
+    The result can be reused across analyses (see the reference dataset registry).
+    """
+    special_df.columns = special_df.columns.str.strip()
+    special_mapping = get_column_mapping(special_df, 'custom')
+    
+    if 'latitude' not in special_mapping or 'longitude' not in special_mapping:
+        raise ValueError(f"Could not identify coordinate columns in custom data. Available: {list(special_df.columns)}")
+    
+    # Prepare custom school coordinates ONCE - cleaned, swapped and validated
+    prepared = prepare_custom_dataset(special_df, special_mapping)
+    print(f"🔄 Swapped lat/lon detected for {prepared['swapped_count']} custom schools: {prepared['swaps_by_source']}")
+    print(f"🧹 Custom coordinate check: {coordinate_reason_counts(prepared['reasons'])}")
+    
+    custom_frame = build_custom_attribute_frame(special_df, special_mapping, prepared['lats'], prepared['lons'])
+    
+    # Build the spatial index once over the valid custom schools
+    index_type = index_type or app.config['SPATIAL_INDEX']
+    valid_mask = prepared['valid_mask']
+    spatial_index = build_spatial_index(prepared['lats'][valid_mask], prepared['lons'][valid_mask], index_type)
+    print(f"🗂️ Spatial index: {type(spatial_index).__name__} over {int(valid_mask.sum())} custom schools")
+    
+    return {
+        'special_df': special_df,
+        'special_mapping': special_mapping,
+        'prepared': prepared,
+        'custom_frame': custom_frame,
+        'spatial_index': spatial_index,
+        'index_type': index_type
+    }
+
+def match_gov_range(spatial_index, valid_indices, gov_lats, gov_lons, gov_valid_mask, start, end, block_size, offset=0,
+                    radius_km=SEARCH_RADIUS_KM):
+    """
+    All matches within radius_km for government rows [start:end) of the given arrays,
+    processed in blocks of block_size. Returns (gov_idx, custom_idx, distance_km) ordered by
+    government row, then distance, then custom row; gov_idx is shifted by offset.
+    """
+    parts = []
+    for block_start in range(start, end, block_size):
+        block_end = min(block_start + block_size, end)
+        block_valid = np.flatnonzero(gov_valid_mask[block_start:block_end]) + block_start
+        
+        # All (gov_idx, custom_idx, distance) triples within the radius for this block, ordered by gov row
+        hit_gov, hit_custom, hit_distances = spatial_index.query_block(gov_lats[block_valid], gov_lons[block_valid], radius_km)
+        hit_gov = block_valid[hit_gov] + offset
+        hit_custom = valid_indices[hit_custom]
+        hit_distances = np.round(hit_distances, 2)
+        
+        # Nearest first within each government school (stable, so ties keep custom row order)
+        order = np.lexsort((hit_custom, hit_distances, hit_gov))
+        parts.append((hit_gov[order], hit_custom[order], hit_distances[order]))
+    
+    if not parts:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+    return tuple(np.concatenate(column) for column in zip(*parts))
+
+def build_source_indexes(prepared, index_type=None):
+    """
+    One spatial index per custom school source over its schools with valid coordinates.
+    Returns [(source, spatial_index, custom row indices)] in source order
+    """
+    valid_indices = prepared['valid_indices']
+    valid_sources = pd.Series(prepared['sources'][valid_indices], dtype=object).fillna('N/A').astype(str).to_numpy()
+    source_indexes = []
+    for source in sorted(set(valid_sources)):
+        rows = valid_indices[valid_sources == source]
+        source_indexes.append((source, build_spatial_index(prepared['lats'][rows], prepared['lons'][rows], index_type), rows))
+    return source_indexes
+
+def match_gov_knn(source_indexes, gov_lats, gov_lons, gov_valid_mask, start, end, block_size, k):
+    """
+    The k nearest custom schools of every source for government rows [start:end), however far
+    away, processed in blocks of block_size. Returns (gov_idx, custom_idx, distance_km) ordered
+    like match_gov_range()
+    """
+    parts = []
+    for block_start in range(start, end, block_size):
+        block_end = min(block_start + block_size, end)
+        block_valid = np.flatnonzero(gov_valid_mask[block_start:block_end]) + block_start
+
+        for _, spatial_index, rows in source_indexes:
+            hit_gov, hit_custom, hit_distances = spatial_index.query_knn_block(gov_lats[block_valid], gov_lons[block_valid], k)
+            parts.append((block_valid[hit_gov], rows[hit_custom], np.round(hit_distances, 2)))
+
+    if not parts:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+    hit_gov, hit_custom, hit_distances = (np.concatenate(column) for column in zip(*parts))
+    order = np.lexsort((hit_custom, hit_distances, hit_gov))
+    return hit_gov[order], hit_custom[order], hit_distances[order]
+
+def match_gov_partition(spec, gov_lats, gov_lons, gov_valid_mask, offset, block_size, radius_km=SEARCH_RADIUS_KM):
+    """Partition worker: match one slice of government schools against the shared custom arrays"""
+    spatial_index, valid_indices = attach_custom_arrays(spec)
+    return match_gov_range(spatial_index, valid_indices, gov_lats, gov_lons, gov_valid_mask,
+                           0, len(gov_lats), block_size, offset, radius_km)
+
+def log_gov_matches(hit_gov, start, end, total_schools, gov_valid_mask, radius_km=SEARCH_RADIUS_KM):
+    """Detailed logging for tracking - first 3 and every 50th school of rows [start:end) (radius_km None in knn mode)"""
+    matches_per_school = np.bincount(hit_gov - start, minlength=end - start)
+    for idx in range(start, end):
+        if idx < 3 or (idx + 1) % 50 == 0:
+            found = matches_per_school[idx - start]
+            if found > 0:
+                print(f"📊 Gov school {idx + 1}/{total_schools}: found {found} custom schools - INCLUDED")
+            else:
+                if not gov_valid_mask[idx]:
+                    status = "invalid coords"
+                elif radius_km is None:
+                    status = "no custom schools with valid coordinates"
+                else:
+                    status = f"no custom schools within {radius_km:g}km"
+                print(f"⊘ Gov school {idx + 1}/{total_schools}: {status} - EXCLUDED")
+
+def match_partitioned(results, spatial_index, index_type, valid_indices, gov_lats, gov_lons, gov_valid_mask,
+                      block_size, workers, session_id=None, progress_callback=None, cancel_token=None,
+                      radius_km=SEARCH_RADIUS_KM):
+    """
+    Run the matching stage over a process pool. Government schools are cut into contiguous
+    chunks (a few per worker, whole blocks each); the custom side is shared through shared memory.
+    Chunks are appended to results in row order as soon as every earlier chunk is in, and
+    progress_callback sees the combined count of finished schools. Returns the processed count.
+    cancel_token is checked after every finished chunk; on cancellation pending chunks are dropped.
+    """
+    total_schools = len(gov_lats)
+    chunk_size = max(block_size, -(-total_schools // (workers * 4) // block_size) * block_size)
+    chunks = [(start, min(start + chunk_size, total_schools)) for start in range(0, total_schools, chunk_size)]
+    print(f"🧵 Partitioned analysis: {len(chunks)} chunks of up to {chunk_size} government schools over {workers} processes")
+    
+    segments, spec = share_custom_arrays(spatial_index, index_type, valid_indices)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(match_gov_partition, spec, gov_lats[start:end], gov_lons[start:end],
+                                gov_valid_mask[start:end], start, block_size, radius_km): chunk_number
+                for chunk_number, (start, end) in enumerate(chunks)
+            }
+            finished = {}
+            next_chunk = 0
+            processed = 0
+            for future in as_completed(futures):
+                if cancel_token:
+                    try:
+                        cancel_token.check()
+                    except AnalysisCancelled:
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        raise
+                chunk_number = futures[future]
+                finished[chunk_number] = future.result()
+                start, end = chunks[chunk_number]
+                processed += end - start
+                
+                # Merge in original row order
+                latest_result = None
+                while next_chunk in finished:
+                    hit_gov, hit_custom, hit_distances = finished.pop(next_chunk)
+                    results.append_block(hit_gov, hit_custom, hit_distances)
+                    log_gov_matches(hit_gov, *chunks[next_chunk], total_schools, gov_valid_mask, radius_km)
+                    if progress_callback and session_id and len(hit_gov):
+                        latest_result = results.block_last_record(hit_gov, hit_custom, hit_distances)
+                    next_chunk += 1
+                
+                if progress_callback and session_id:
+                    progress_callback(session_id, latest_result, processed, total_schools)
+    finally:
+        for segment in segments:
+            segment.close()
+            segment.unlink()
+    return processed
+
+def analyze_distances(gov_df, special_df, session_id=None, progress_callback=None, index_type=None, custom_dataset=None,
+                      partition_workers=None, cancel_token=None, radius_km=None, rings=None, mode='radius', k=1):
+    """
+    For each government school, find ALL custom schools (BEAC/NCHD/BEF) within radius_km
+    (default SEARCH_RADIUS_KM). Returns a ColumnarResults with one entry per gov-to-custom
+    match (multiple per government school); each match is labelled with its distance ring
+    (boundaries rings within radius_km, default default_rings(radius_km)) from the same single
+    search; matches beyond the outermost ring fall in the last, open-ended ring
+
+    mode='knn' instead finds the k nearest custom schools of each source for every government
+    school with valid coordinates, however far away (radius_km is ignored)
+
+    index_type selects the spatial index used for the radius search ('grid' or 'brute'),
+    defaulting to app.config['SPATIAL_INDEX']
+    custom_dataset is a prebuilt build_custom_dataset() result (e.g. a registered reference
+    dataset); when given, special_df is ignored and no custom-side preparation is repeated
+    partition_workers > 1 splits the government schools across that many processes
+    (default app.config['PARTITION_WORKERS'], used from PARTITION_MIN_SCHOOLS schools up)
+    cancel_token (a CancellationToken) is checked between blocks and raises AnalysisCancelled
     """
-    results = []
     total_schools = len(gov_df)  # Iterate through government schools
     processed = 0
+    if mode not in ANALYSIS_MODES:
+        raise ValueError(f"Unknown analysis mode '{mode}'. Available: {list(ANALYSIS_MODES)}")
+    knn = mode == 'knn'
+    radius_km = None if knn else (radius_km or SEARCH_RADIUS_KM)
+    rings = tuple(rings or default_rings(radius_km))
+    search_label = f"the nearest {k} per source" if knn else f"{radius_km:g}km"
     
     # Standardize column names
     gov_df.columns = gov_df.columns.str.strip()
-    special_df.columns = special_df.columns.str.strip()
+    gov_mapping = get_column_mapping(gov_df, 'government')
+    
+    # Validate required columns
+    if 'latitude' not in gov_mapping or 'longitude' not in gov_mapping:
+        raise ValueError(f"Could not identify coordinate columns in government data. Available: {list(gov_df.columns)}")
+    
+    if custom_dataset is None:
+        custom_dataset = build_custom_dataset(special_df, index_type)
+    elif index_type and index_type != custom_dataset['index_type']:
+        prepared = custom_dataset['prepared']
+        custom_dataset = dict(custom_dataset,
+                              spatial_index=build_spatial_index(prepared['lats'][prepared['valid_mask']],
+                                                                prepared['lons'][prepared['valid_mask']], index_type),
+                              index_type=index_type)
+    
+    special_df = custom_dataset['special_df']
+    special_mapping = custom_dataset['special_mapping']
+    prepared = custom_dataset['prepared']
+    spatial_index = custom_dataset['spatial_index']
     
     print(f"Government schools columns: {list(gov_df.columns)}")
     print(f"Custom schools columns: {list(special_df.columns)}")
     
-    # Get column mappings for both datasets
-    gov_mapping = get_column_mapping(gov_df, 'government')
-    special_mapping = get_column_mapping(special_df, 'custom')
-    
     print(f"Government column mapping: {gov_mapping}")
     print(f"Custom column mapping: {special_mapping}")
     
@@ -231,298 +1714,169 @@ def analyze_distances(gov_df, special_df, session_id=None, progress_callback=Non
             print(f"         Source='{src}', School_Owned='{owned}'")
     print()
     
-    # Validate required columns
-    if 'latitude' not in gov_mapping or 'longitude' not in gov_mapping:
-        raise ValueError(f"Could not identify coordinate columns in government data. Available: {list(gov_df.columns)}")
-    
-    if 'latitude' not in special_mapping or 'longitude' not in special_mapping:
-        raise ValueError(f"Could not identify coordinate columns in custom data. Available: {list(special_df.columns)}")
-    
     print(f"Coordinate columns detected:")
     print(f"  Gov Latitude: {gov_mapping['latitude']}, Gov Longitude: {gov_mapping['longitude']}")
     print(f"  Custom Latitude: {special_mapping['latitude']}, Custom Longitude: {special_mapping['longitude']}")
     
     print(f"Enrollment column found: {gov_mapping.get('enrollment', 'Not found')}")
     
-    # Pre-calculate custom school source breakdown for comparison tracking
-    source_col = special_mapping.get('source')
-    custom_sources_available = {}
-    custom_sources_with_valid_coords = {}
+    # Prepared custom school coordinates - cleaned, swapped and validated
+    custom_lats = prepared['lats']
+    custom_lons = prepared['lons']
+    valid_mask = prepared['valid_mask']
+    valid_indices = prepared['valid_indices']
+    custom_sources = prepared['sources']
     
+    # Pre-calculate custom school source breakdown for comparison tracking
     if source_col:
-        for idx, row in special_df.iterrows():
-            source = row.get(source_col, 'Unknown')
-            custom_sources_available[source] = custom_sources_available.get(source, 0) + 1
+        source_series = pd.Series(custom_sources)
+        custom_sources_available = source_series.value_counts(dropna=False).to_dict()
+        custom_sources_with_valid_coords = source_series[valid_mask].value_counts(dropna=False).to_dict()
+        
+        print(f"\n📌 Custom Schools Available for Comparison:")
+        for src in sorted(custom_sources_available.keys(), key=str):
+            total = custom_sources_available[src]
+            valid = custom_sources_with_valid_coords.get(src, 0)
+            invalid = total - valid
+            print(f"   {src}: {total} schools total ({valid} with valid coordinates, {invalid} invalid)")
             
-            # Check if this school has valid coordinates
-            lat = clean_coordinate(row.get(special_mapping['latitude']))
-            lon = clean_coordinate(row.get(special_mapping['longitude']))
-            if lat is not None and lon is not None:
-                custom_sources_with_valid_coords[source] = custom_sources_with_valid_coords.get(source, 0) + 1
-    
-    print(f"\n📌 Custom Schools Available for Comparison:")
-    for src in sorted(custom_sources_available.keys()):
-        total = custom_sources_available[src]
-        valid = custom_sources_with_valid_coords.get(src, 0)
-        invalid = total - valid
-        print(f"   {src}: {total} schools total ({valid} with valid coordinates, {invalid} invalid)")
-        
-        # Show sample coordinates for each source
-        if valid > 0 and src in ['BEAC', 'NCHD', 'BEF']:
-            source_schools = special_df[special_df[source_col] == src]
-            sample_count = 0
-            print(f"      Sample {src} coordinates:")
-            for idx, school in source_schools.iterrows():
-                lat = clean_coordinate(school.get(special_mapping['latitude']))
-                lon = clean_coordinate(school.get(special_mapping['longitude']))
-                if lat is not None and lon is not None:
+            # Show sample coordinates for each source
+            if valid > 0 and src in ['BEAC', 'NCHD', 'BEF']:
+                print(f"      Sample {src} coordinates:")
+                sample_indices = np.flatnonzero(valid_mask & (custom_sources == src))[:2]  # Show 2 samples per source
+                for idx in sample_indices:
+                    school = special_df.iloc[idx]
                     name = school.get(special_mapping.get('school_name', 'Unknown'), 'Unknown')
                     district = school.get(special_mapping.get('district', 'Unknown'), 'Unknown')
-                    print(f"         {name[:40]} ({district}): Lat={lat:.6f}, Lon={lon:.6f}")
-                    sample_count += 1
-                    if sample_count >= 2:  # Show 2 samples per source
-                        break
+                    print(f"         {str(name)[:40]} ({district}): Lat={custom_lats[idx]:.6f}, Lon={custom_lons[idx]:.6f}")
     print()
     
-    # Process each government school
-    valid_gov_schools = 0
-    invalid_coordinate_schools = 0
-    first_school_sample_done = False
+    # Clean government coordinates for the whole file at once
+    gov_lats, gov_lons, gov_reasons = clean_coordinates(gov_df[gov_mapping['latitude']], gov_df[gov_mapping['longitude']])
+    gov_valid_mask = ~(np.isnan(gov_lats) | np.isnan(gov_lons))
+    valid_gov_schools = int(gov_valid_mask.sum())
+    invalid_coordinate_schools = total_schools - valid_gov_schools
+    print(f"🧹 Government coordinate check: {coordinate_reason_counts(gov_reasons)}")
     
-    for idx, gov_school in gov_df.iterrows():
-        gov_lat = clean_coordinate(gov_school.get(gov_mapping['latitude']))
-        gov_lon = clean_coordinate(gov_school.get(gov_mapping['longitude']))
+    for count, idx in enumerate(np.flatnonzero(~gov_valid_mask)[:3], 1):  # Log first 3 invalid schools
+        school_name = gov_df.iloc[idx].get(gov_mapping.get('school_name'), 'N/A')
+        print(f"⚠️ School {idx + 1}/{total_schools}: {school_name} - Invalid coordinates (excluded from distance search)")
+    
+    # DIAGNOSTIC: For first valid school, show detailed analysis
+    first_valid = np.flatnonzero(gov_valid_mask)[:1]
+    if len(first_valid) and len(valid_indices) > 0 and source_col:
+        first_school = gov_df.iloc[first_valid[0]]
+        gov_lat = gov_lats[first_valid[0]]
+        gov_lon = gov_lons[first_valid[0]]
+        
+        # Full distance scan for this one school only (nearest per source, 10km counts)
+        distances = haversine_vectorized(gov_lat, gov_lon, 
+                                        custom_lats[valid_mask], 
+                                        custom_lons[valid_mask])
         
-        # Track schools with invalid coordinates
-        has_valid_coords = gov_lat is not None and gov_lon is not None
+        print(f"\n🔍 DIAGNOSTIC - First Government School Analysis:")
+        print(f"   School: {first_school.get(gov_mapping.get('school_name'), 'N/A')}")
+        print(f"   District: {first_school.get(gov_mapping.get('district'), 'N/A')}")
+        print(f"   Coordinates: Lat={gov_lat:.6f}, Lon={gov_lon:.6f}")
+        print(f"\n   🔍 Checking source column values during distance calc:")
+        print(f"   Source column name: '{source_col}'")
         
-        if not has_valid_coords:
-            invalid_coordinate_schools += 1
-            if invalid_coordinate_schools <= 3:  # Log first 3 invalid schools
-                school_name = gov_school.get(gov_mapping.get('school_name'), 'N/A')
-                print(f"⚠️ School {idx + 1}/{total_schools}: {school_name} - Invalid coordinates (will still be included in results)")
-        else:
-            valid_gov_schools += 1
-            if valid_gov_schools <= 2:  # Log first 2 valid schools
-                school_name = gov_school.get(gov_mapping.get('school_name', 'N/A'), 'N/A')
-                print(f"✓ Processing school {idx + 1}/{total_schools}: {school_name} - Lat: {gov_lat}, Lon: {gov_lon}")
-        
-        # Get government school info using flexible mapping
-        gov_school_name = gov_school.get(gov_mapping.get('school_name'), 'N/A')
-        gov_bemis_code = gov_school.get(gov_mapping.get('bemis_code'), 'N/A')
-        gov_district = gov_school.get(gov_mapping.get('district'), 'N/A')
-        gov_tehsil = gov_school.get(gov_mapping.get('tehsil'), 'N/A')
-        gov_uc = gov_school.get(gov_mapping.get('uc'), 'N/A')
-        gov_level = gov_school.get(gov_mapping.get('level'), 'N/A')
-        gov_gender = gov_school.get(gov_mapping.get('gender'), 'N/A')
-        
-        # Additional government school fields
-        gov_space_for_rooms = gov_school.get(gov_mapping.get('space_for_rooms'), 'N/A')
-        gov_total_rooms = gov_school.get(gov_mapping.get('total_rooms'), 'N/A')
-        gov_toilets = gov_school.get(gov_mapping.get('toilets'), 'N/A')
-        gov_boundary_wall = gov_school.get(gov_mapping.get('boundary_wall'), 'N/A')
-        gov_drinking_water = gov_school.get(gov_mapping.get('drinking_water'), 'N/A')
-        
-        # Get enrollment value
-        enrollment_col = gov_mapping.get('enrollment')
-        enrollment_value = gov_school.get(enrollment_col, 'N/A') if enrollment_col else 'N/A'
-        if pd.isna(enrollment_value) or str(enrollment_value).strip().upper() == 'N/A':
-            enrollment_value = 'N/A'
-        
-        # Find ALL custom schools within 5km using vectorized calculation
-        custom_schools_within_5km = []
-        
-        # Only calculate distances if government school has valid coordinates
-        if has_valid_coords:
-            # Vectorized distance calculation to all custom schools at once
-            # SPECIAL HANDLING: BEAC and NCHD schools have swapped coordinates in the data
-            custom_lats_raw = special_df[special_mapping['latitude']].apply(clean_coordinate).values
-            custom_lons_raw = special_df[special_mapping['longitude']].apply(clean_coordinate).values
-            
-            # Swap coordinates for BEAC and NCHD schools only
-            custom_lats = custom_lats_raw.copy()
-            custom_lons = custom_lons_raw.copy()
-            
-            if source_col:
-                for idx in range(len(special_df)):
-                    source = special_df.iloc[idx].get(source_col)
-                    if source in ['BEAC', 'NCHD']:
-                        # Swap lat/lon for BEAC and NCHD
-                        custom_lats[idx] = custom_lons_raw[idx]
-                        custom_lons[idx] = custom_lats_raw[idx]
-            
-            # Filter out invalid coordinates
-            valid_mask = ~(pd.isna(custom_lats) | pd.isna(custom_lons))
-            valid_indices = np.where(valid_mask)[0]
+        # Show what source values are actually in the valid schools
+        valid_source_values = pd.Series(custom_sources[valid_mask]).value_counts(dropna=False).to_dict()
+        
+        print(f"   Source values in schools with valid coordinates:")
+        for src, cnt in valid_source_values.items():
+            print(f"      '{src}': {cnt} schools")
+        
+        print(f"\n   Distance analysis for each source type:")
+        
+        for check_source in ['BEAC', 'NCHD', 'BEF']:
+            print(f"\n      Checking for source = '{check_source}':")
+            source_mask = custom_sources[valid_mask] == check_source
+            print(f"         Schools matching '{check_source}': {source_mask.sum()}")
             
-            if len(valid_indices) > 0:
-                # Calculate all distances at once
-                distances = haversine_vectorized(gov_lat, gov_lon, 
-                                                custom_lats[valid_mask], 
-                                                custom_lons[valid_mask])
+            if source_mask.any():
+                source_distances = distances[source_mask]
+                source_indices = valid_indices[source_mask]
                 
-                # DIAGNOSTIC: For first valid school, show detailed analysis
-                if not first_school_sample_done and source_col:
-                    print(f"\n🔍 DIAGNOSTIC - First Government School Analysis:")
-                    print(f"   School: {gov_school_name}")
-                    print(f"   District: {gov_district}")
-                    print(f"   Coordinates: Lat={gov_lat:.6f}, Lon={gov_lon:.6f}")
-                    print(f"\n   🔍 Checking source column values during distance calc:")
-                    print(f"   Source column name: '{source_col}'")
-                    
-                    # Show what source values are actually in the valid schools
-                    valid_source_values = {}
-                    for idx in valid_indices:
-                        src_val = special_df.iloc[idx].get(source_col)
-                        valid_source_values[src_val] = valid_source_values.get(src_val, 0) + 1
-                    
-                    print(f"   Source values in schools with valid coordinates:")
-                    for src, cnt in valid_source_values.items():
-                        print(f"      '{src}': {cnt} schools")
-                    
-                    print(f"\n   Distance analysis for each source type:")
-                    
-                    for check_source in ['BEAC', 'NCHD', 'BEF']:
-                        print(f"\n      Checking for source = '{check_source}':")
-                        source_mask = np.array([special_df.iloc[i].get(source_col) == check_source for i in valid_indices])
-                        print(f"         Schools matching '{check_source}': {source_mask.sum()}")
-                        
-                        if source_mask.any():
-                            source_distances = distances[source_mask]
-                            source_indices = valid_indices[source_mask]
-                            
-                            nearest_dist = source_distances.min()
-                            nearest_idx = source_indices[np.argmin(source_distances)]
-                            nearest_school = special_df.iloc[nearest_idx]
-                            nearest_name = nearest_school.get(special_mapping.get('school_name'), 'Unknown')
-                            nearest_district = nearest_school.get(special_mapping.get('district'), 'Unknown')
-                            
-                            within_5km = (source_distances <= 5.0).sum()
-                            within_10km = (source_distances <= 10.0).sum()
-                            
-                            print(f"         ✅ Found {len(source_distances)} {check_source} schools")
-                            print(f"         Nearest: {nearest_name[:50]} ({nearest_district})")
-                            print(f"         Distance: {nearest_dist:.2f} km")
-                            print(f"         Within 5km: {within_5km} schools")
-                            print(f"         Within 10km: {within_10km} schools")
-                            
-                            # Show closest 3 schools
-                            sorted_idx = np.argsort(source_distances)[:3]
-                            print(f"         Closest 3 schools:")
-                            for rank, idx_pos in enumerate(sorted_idx, 1):
-                                sch_idx = source_indices[idx_pos]
-                                dist = source_distances[idx_pos]
-                                sch = special_df.iloc[sch_idx]
-                                sch_name = sch.get(special_mapping.get('school_name'), 'Unknown')
-                                print(f"            {rank}. {sch_name[:40]} - {dist:.2f} km")
-                        else:
-                            print(f"         ❌ No schools found with source='{check_source}'")
-                            print(f"         This means the Source column doesn't contain '{check_source}'")
-                    
-                    first_school_sample_done = True
-                    print()
+                nearest_dist = source_distances.min()
+                nearest_idx = source_indices[np.argmin(source_distances)]
+                nearest_school = special_df.iloc[nearest_idx]
+                nearest_name = nearest_school.get(special_mapping.get('school_name'), 'Unknown')
+                nearest_district = nearest_school.get(special_mapping.get('district'), 'Unknown')
                 
-                # Find schools within 5km
-                within_5km_mask = distances <= 5.0
-                within_5km_indices = valid_indices[within_5km_mask]
-                within_5km_distances = distances[within_5km_mask]
+                within_5km = (source_distances <= 5.0).sum()
+                within_10km = (source_distances <= 10.0).sum()
                 
-                # Create result entries for schools within 5km
-                for idx_offset, (custom_idx, distance) in enumerate(zip(within_5km_indices, within_5km_distances)):
-                    custom_school = special_df.iloc[custom_idx]
-                    custom_source_val = custom_school.get(special_mapping.get('source'), 'N/A')
-                    
-                    # Use the corrected coordinates (already swapped above for BEAC/NCHD)
-                    custom_info = {
-                        'custom_school_name': custom_school.get(special_mapping.get('school_name'), 'N/A'),
-                        'custom_bemis_code': custom_school.get(special_mapping.get('bemis_code'), 'N/A'),
-                        'custom_division': custom_school.get(special_mapping.get('division'), 'N/A'),
-                        'custom_district': custom_school.get(special_mapping.get('district'), 'N/A'),
-                        'custom_tehsil': custom_school.get(special_mapping.get('tehsil'), 'N/A'),
-                        'custom_level': custom_school.get(special_mapping.get('level'), 'N/A'),
-                        'custom_gender': custom_school.get(special_mapping.get('gender'), 'N/A'),
-                        'custom_students': custom_school.get(special_mapping.get('enrollment'), 'N/A'),
-                        'custom_functional_status': custom_school.get(special_mapping.get('functional_status'), 'N/A'),
-                        'custom_source': custom_source_val,
-                        'distance': round(float(distance), 2),
-                        'custom_latitude': custom_lats[custom_idx],  # Already corrected
-                        'custom_longitude': custom_lons[custom_idx]  # Already corrected
-                    }
-                    custom_schools_within_5km.append(custom_info)
-            
-            # Sort by distance (nearest first)
-            custom_schools_within_5km.sort(key=lambda x: x['distance'])
-        
-        # Create result rows - ONLY for schools with custom schools within 5km
-        if has_valid_coords and len(custom_schools_within_5km) > 0:
-            # Create a result row for each custom school within 5km
-            for custom_info in custom_schools_within_5km:
-                result = {
-                    'gov_school_name': gov_school_name,
-                    'gov_bemis_code': gov_bemis_code,
-                    'gov_district': gov_district,
-                    'gov_tehsil': gov_tehsil,
-                    'gov_uc': gov_uc,
-                    'gov_level': gov_level,
-                    'gov_gender': gov_gender,
-                    'gov_enrollment': enrollment_value,
-                    'gov_space_for_rooms': gov_space_for_rooms,
-                    'gov_total_rooms': gov_total_rooms,
-                    'gov_toilets': gov_toilets,
-                    'gov_boundary_wall': gov_boundary_wall,
-                    'gov_drinking_water': gov_drinking_water,
-                    'gov_latitude': gov_lat,
-                    'gov_longitude': gov_lon,
-                    'custom_school_name': custom_info['custom_school_name'],
-                    'custom_bemis_code': custom_info['custom_bemis_code'],
-                    'custom_division': custom_info['custom_division'],
-                    'custom_district': custom_info['custom_district'],
-                    'custom_tehsil': custom_info['custom_tehsil'],
-                    'custom_level': custom_info['custom_level'],
-                    'custom_gender': custom_info['custom_gender'],
-                    'custom_students': custom_info['custom_students'],
-                    'custom_functional_status': custom_info['custom_functional_status'],
-                    'custom_source': custom_info['custom_source'],
-                    'distance_km': custom_info['distance'],
-                    'custom_latitude': custom_info['custom_latitude'],
-                    'custom_longitude': custom_info['custom_longitude'],
-                    'custom_schools_count': len(custom_schools_within_5km)
-                }
-                results.append(result)
-        
-        processed += 1
-        
-        # Detailed logging for tracking
-        if processed <= 3 or processed % 50 == 0:  # Log first 3 and every 50th school
-            if has_valid_coords and len(custom_schools_within_5km) > 0:
-                print(f"📊 Gov school {processed}/{total_schools}: found {len(custom_schools_within_5km)} custom schools - INCLUDED")
+                print(f"         ✅ Found {len(source_distances)} {check_source} schools")
+                print(f"         Nearest: {nearest_name[:50]} ({nearest_district})")
+                print(f"         Distance: {nearest_dist:.2f} km")
+                print(f"         Within 5km: {within_5km} schools")
+                print(f"         Within 10km: {within_10km} schools")
+                
+                # Show closest 3 schools
+                sorted_idx = np.argsort(source_distances)[:3]
+                print(f"         Closest 3 schools:")
+                for rank, idx_pos in enumerate(sorted_idx, 1):
+                    sch_idx = source_indices[idx_pos]
+                    dist = source_distances[idx_pos]
+                    sch = special_df.iloc[sch_idx]
+                    sch_name = sch.get(special_mapping.get('school_name'), 'Unknown')
+                    print(f"            {rank}. {sch_name[:40]} - {dist:.2f} km")
             else:
-                status = "invalid coords" if not has_valid_coords else "no custom schools within 5km"
-                print(f"⊘ Gov school {processed}/{total_schools}: {status} - EXCLUDED")
-        
-        # Report progress less frequently (every 10 schools instead of every school)
-        if progress_callback and session_id and (processed % 10 == 0 or processed == total_schools):
-            # Always report progress with the latest result
-            if results:  # If we have any results at all
-                progress_callback(session_id, results[-1], processed, total_schools)
-            elif processed == total_schools:  # End of processing
-                progress_callback(session_id, None, processed, total_schools)
+                print(f"         ❌ No schools found with source='{check_source}'")
+                print(f"         This means the Source column doesn't contain '{check_source}'")
+        print()
+    
+    # Matches are stored by row reference; attributes are joined at export time
+    results = ColumnarResults(build_gov_attribute_frame(gov_df, gov_mapping, gov_lats, gov_lons),
+                              custom_dataset['custom_frame'], radius_km, rings, k if knn else None)
+    
+    # Process government schools in blocks - one (block x custom) distance tile per block
+    block_size = choose_block_size(len(valid_indices))
+    print(f"🧮 Distance kernel: {total_schools} government schools in blocks of {block_size}, "
+          f"{'search ' if knn else 'radius '}{search_label}, rings {ring_labels(rings)}")
+    
+    partition_workers = partition_workers or app.config['PARTITION_WORKERS']
+    if not knn and partition_workers > 1 and total_schools >= app.config['PARTITION_MIN_SCHOOLS']:
+        processed = match_partitioned(results, spatial_index, custom_dataset['index_type'], valid_indices,
+                                      gov_lats, gov_lons, gov_valid_mask, block_size, partition_workers,
+                                      session_id, progress_callback, cancel_token, radius_km)
+    else:
+        if knn:
+            # One index per source so every source contributes its own k nearest
+            source_indexes = build_source_indexes(prepared, custom_dataset['index_type'])
+            print(f"🧭 Nearest-neighbour search over sources: {[source for source, _, _ in source_indexes]}")
+        for block_start in range(0, total_schools, block_size):
+            if cancel_token:
+                cancel_token.check()
+            block_end = min(block_start + block_size, total_schools)
+            if knn:
+                hit_gov, hit_custom, hit_distances = match_gov_knn(source_indexes, gov_lats, gov_lons, gov_valid_mask,
+                                                                   block_start, block_end, block_size, k)
+            else:
+                hit_gov, hit_custom, hit_distances = match_gov_range(spatial_index, valid_indices, gov_lats, gov_lons,
+                                                                     gov_valid_mask, block_start, block_end, block_size,
+                                                                     radius_km=radius_km)
+            results.append_block(hit_gov, hit_custom, hit_distances)
+            log_gov_matches(hit_gov, block_start, block_end, total_schools, gov_valid_mask, radius_km)
+            processed = block_end
+            
+            # Report progress once per block, with the latest result if this block produced any
+            if progress_callback and session_id:
+                latest_result = results.block_last_record(hit_gov, hit_custom, hit_distances) if len(hit_gov) else None
+                progress_callback(session_id, latest_result, processed, total_schools)
     
     # Count results by custom school source type
-    source_breakdown = {}
-    for r in results:
-        source = r.get('custom_source', 'N/A')
-        source_breakdown[source] = source_breakdown.get(source, 0) + 1
+    result_sources = pd.Series(results.column('custom_source'), dtype=object)
+    source_breakdown = result_sources.value_counts(dropna=False).to_dict()
     
     # Count unique custom schools found by source
     unique_custom_found = {}
-    for r in results:
-        if r.get('custom_source') != 'N/A':
-            key = f"{r['custom_school_name']}_{r['custom_source']}"
-            source = r.get('custom_source', 'Unknown')
-            if source not in unique_custom_found:
-                unique_custom_found[source] = set()
-            unique_custom_found[source].add(key)
+    found = pd.DataFrame({'name': results.column('custom_school_name'), 'source': result_sources})
+    found = found[found['source'] != 'N/A']
+    for source, group in found.groupby('source', dropna=False):
+        unique_custom_found[source] = group['name'].astype(str).nunique()
     
     print(f"\n=== Analysis Complete ===")
     print(f"✓ Total government schools in file: {total_schools}")
@@ -531,23 +1885,23 @@ def analyze_distances(gov_df, special_df, session_id=None, progress_callback=Non
     print(f"⚠️ Schools with invalid coordinates: {invalid_coordinate_schools}")
     print(f"✓ Total result rows generated: {len(results)}")
     print(f"\n📊 Results by Custom School Source (Result Rows):")
-    for source, count in sorted(source_breakdown.items()):
+    for source, count in sorted(source_breakdown.items(), key=lambda item: str(item[0])):
         print(f"   {source}: {count} result rows")
     
-    print(f"\n🎯 Unique Custom Schools Found Within 5km:")
+    print(f"\n🎯 Unique Custom Schools Found Within {search_label}:")
     if unique_custom_found:
-        for source in sorted(unique_custom_found.keys()):
-            print(f"   {source}: {len(unique_custom_found[source])} unique schools found")
+        for source in sorted(unique_custom_found.keys(), key=str):
+            print(f"   {source}: {unique_custom_found[source]} unique schools found")
     else:
-        print(f"   No custom schools found within 5km of any government school")
+        print(f"   No custom schools found within {search_label} of any government school")
     
     # Show which sources were available but not found
-    gov_schools_with_matches = len(set(r['gov_school_name'] for r in results if r.get('custom_source') != 'N/A'))
+    gov_schools_with_matches = pd.Series(results.column('gov_school_name')[result_sources.to_numpy() != 'N/A'], dtype=object).nunique(dropna=False)
     gov_schools_excluded = total_schools - gov_schools_with_matches
     
     print(f"\n📍 Summary:")
     print(f"   - Government schools WITH custom schools nearby: {gov_schools_with_matches} (INCLUDED in results)")
-    print(f"   - Government schools with NO custom schools within 5km: {gov_schools_excluded} (EXCLUDED from results)")
+    print(f"   - Government schools with NO custom schools within {search_label}: {gov_schools_excluded} (EXCLUDED from results)")
     print(f"\n✅ Only government schools with nearby custom schools are included.")
     print(f"📊 Total result rows: {len(results)} (showing gov-to-custom school matches)")
     
@@ -561,89 +1915,65 @@ def generate_summary_statistics(results):
             'total_gov_schools': 0,
             'total_custom_schools_found': 0,
             'avg_distance': 0,
-            'avg_custom_schools_per_gov': 0
+            'avg_custom_schools_per_gov': 0,
+            'mode': 'knn' if results.nearest_k else 'radius',
+            'nearest_k': results.nearest_k,
+            'radius_km': results.radius_km,
+            'rings': list(results.rings)
         }
     
+    # Work on the result columns directly - no per-row dicts needed
+    gov_names = pd.Series(results.column('gov_school_name'), dtype=object)
+    sources = results.column('custom_source')
+    distances = results.column('distance_km')
+    
     # Get unique government schools
-    unique_gov_schools = set(r['gov_school_name'] for r in results)
+    unique_gov_schools = gov_names.nunique(dropna=False)
     
     # Count total custom schools found (exclude N/A entries)
-    total_custom_schools = len([r for r in results if r.get('custom_source') != 'N/A'])
+    total_custom_schools = int((sources != 'N/A').sum())
     
-    # Calculate average distance - filter out 'N/A' string values
-    distances = [r['distance_km'] for r in results if isinstance(r['distance_km'], (int, float))]
-    avg_distance = round(np.mean(distances), 2) if distances else 0
+    # Calculate average distance
+    avg_distance = round(np.mean(distances), 2) if len(distances) else 0
     
     # Calculate average distances by source type (BEAC, NCHD, BEF only)
-    beac_distances = [r['distance_km'] for r in results if r.get('custom_source') == 'BEAC' and isinstance(r['distance_km'], (int, float))]
-    nchd_distances = [r['distance_km'] for r in results if r.get('custom_source') == 'NCHD' and isinstance(r['distance_km'], (int, float))]
-    bef_distances = [r['distance_km'] for r in results if r.get('custom_source') == 'BEF' and isinstance(r['distance_km'], (int, float))]
+    beac_distances = distances[sources == 'BEAC']
+    nchd_distances = distances[sources == 'NCHD']
+    bef_distances = distances[sources == 'BEF']
     
-    avg_beac_distance = round(np.mean(beac_distances), 2) if beac_distances else 0
-    avg_nchd_distance = round(np.mean(nchd_distances), 2) if nchd_distances else 0
-    avg_bef_distance = round(np.mean(bef_distances), 2) if bef_distances else 0
+    avg_beac_distance = round(np.mean(beac_distances), 2) if len(beac_distances) else 0
+    avg_nchd_distance = round(np.mean(nchd_distances), 2) if len(nchd_distances) else 0
+    avg_bef_distance = round(np.mean(bef_distances), 2) if len(bef_distances) else 0
     
     # Calculate average custom schools per government school
-    gov_school_counts = {}
-    for r in results:
-        gov_name = r['gov_school_name']
-        if gov_name not in gov_school_counts:
-            gov_school_counts[gov_name] = 0
-        gov_school_counts[gov_name] += 1
-    
-    avg_custom_per_gov = round(np.mean(list(gov_school_counts.values())), 1) if gov_school_counts else 0
-    
-    # Distance ranges by source type
-    beac_dist_0_2 = sum(1 for d in beac_distances if d <= 2)
-    beac_dist_2_5 = sum(1 for d in beac_distances if 2 < d <= 5)
-    beac_dist_5_10 = 0  # We only show up to 5km
-    beac_dist_10_plus = 0
-    
-    nchd_dist_0_2 = sum(1 for d in nchd_distances if d <= 2)
-    nchd_dist_2_5 = sum(1 for d in nchd_distances if 2 < d <= 5)
-    nchd_dist_5_10 = 0
-    nchd_dist_10_plus = 0
-    
-    bef_dist_0_2 = sum(1 for d in bef_distances if d <= 2)
-    bef_dist_2_5 = sum(1 for d in bef_distances if 2 < d <= 5)
-    bef_dist_5_10 = 0
-    bef_dist_10_plus = 0
-    
-    # Overall distance ranges
-    dist_0_2 = sum(1 for d in distances if d <= 2)
-    dist_2_5 = sum(1 for d in distances if 2 < d <= 5)
+    gov_school_counts = gov_names.value_counts(dropna=False)
+    avg_custom_per_gov = round(np.mean(gov_school_counts.values), 1) if len(gov_school_counts) else 0
+    
+    # Distance ring counts, overall and by source type - from each match's ring label
+    labels = ring_labels(results.rings)
+    rings = ring_index(distances, results.rings)
+    
+    def ring_counts(mask=None):
+        counts = np.bincount(rings if mask is None else rings[mask], minlength=len(labels))
+        return {label: int(count) for label, count in zip(labels, counts)}
     
     summary = {
         'total_rows': total_custom_schools,
-        'total_gov_schools': len(unique_gov_schools),
+        'total_gov_schools': unique_gov_schools,
         'total_custom_schools_found': total_custom_schools,
         'avg_distance': avg_distance,
         'avg_beac_distance': avg_beac_distance,
         'avg_nchd_distance': avg_nchd_distance,
         'avg_bef_distance': avg_bef_distance,
         'avg_custom_schools_per_gov': avg_custom_per_gov,
-        'distance_ranges': {
-            '0-2km': dist_0_2,
-            '2-5km': dist_2_5
-        },
-        'beac_distance_ranges': {
-            '0-2km': beac_dist_0_2,
-            '2-5km': beac_dist_2_5,
-            '5-10km': beac_dist_5_10,
-            '10+km': beac_dist_10_plus
-        },
-        'nchd_distance_ranges': {
-            '0-2km': nchd_dist_0_2,
-            '2-5km': nchd_dist_2_5,
-            '5-10km': nchd_dist_5_10,
-            '10+km': nchd_dist_10_plus
-        },
-        'bef_distance_ranges': {
-            '0-2km': bef_dist_0_2,
-            '2-5km': bef_dist_2_5,
-            '5-10km': bef_dist_5_10,
-            '10+km': bef_dist_10_plus
-        },
+        'mode': 'knn' if results.nearest_k else 'radius',
+        'nearest_k': results.nearest_k,
+        'radius_km': results.radius_km,
+        'rings': list(results.rings),
+        'distance_ranges': ring_counts(),
+        'beac_distance_ranges': ring_counts(sources == 'BEAC'),
+        'nchd_distance_ranges': ring_counts(sources == 'NCHD'),
+        'bef_distance_ranges': ring_counts(sources == 'BEF'),
         'nearest_beac_count': len(beac_distances),
         'nearest_nchd_count': len(nchd_distances),
         'nearest_bef_count': len(bef_distances)
@@ -651,18 +1981,523 @@ def generate_summary_statistics(results):
     
     return summary
 
-def process_analysis_background(session_id, gov_path, special_path):
+def is_valid_reference_id(reference_id):
+    return bool(re.fullmatch(r'[0-9a-f]{16}', reference_id or ''))
+
+def reference_dir(reference_id):
+    return os.path.join(app.config['REFERENCE_FOLDER'], reference_id)
+
+def reference_id_for_file(file_path):
+    """Registry ID of a custom schools file - the first 16 hex digits of its content hash"""
+    return hash_file(file_path)[:16]
+
+def reference_meta(reference_id):
+    """Registry metadata of a reference dataset, or None if not registered"""
+    meta_path = os.path.join(reference_dir(reference_id), 'meta.json')
+    if not is_valid_reference_id(reference_id) or not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        return json.load(f)
+
+def spatial_index_state(spatial_index):
+    """Plain dict of the index's arrays/scalars, so the pickle does not depend on the module name"""
+    return dict(vars(spatial_index))
+
+def restore_spatial_index(index_type, state):
+    spatial_index = SPATIAL_INDEX_TYPES[index_type].__new__(SPATIAL_INDEX_TYPES[index_type])
+    spatial_index.__dict__.update(state)
+    return spatial_index
+
+def register_reference_dataset(file_path, original_filename):
+    """
+    Register a custom schools file in the reference dataset registry.
+    The file is content-hashed; an already registered file is not parsed again.
+    Otherwise it is parsed and prepared once and stored on disk (DataFrames, prepared
+    coordinate arrays and spatial index) for later analyses. Returns the registry metadata.
+    """
+    file_hash = hash_file(file_path)
+    reference_id = file_hash[:16]
+    ref_dir = reference_dir(reference_id)
+    meta_path = os.path.join(ref_dir, 'meta.json')
+    
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        print(f"📚 Reference dataset {reference_id} already registered ({meta['filename']})")
+        return meta
+    
+    special_df = read_excel_or_csv(file_path, file_hash)
+    dataset = build_custom_dataset(special_df)
+    
+    os.makedirs(ref_dir, exist_ok=True)
+    stored = {key: value for key, value in dataset.items() if key != 'spatial_index'}
+    stored['spatial_index_state'] = spatial_index_state(dataset['spatial_index'])
+    pd.to_pickle(stored, os.path.join(ref_dir, 'dataset.pkl'))
+    
+    sources = pd.Series(dataset['prepared']['sources']).value_counts(dropna=False)
+    meta = {
+        'reference_id': reference_id,
+        'sha256': file_hash,
+        'filename': original_filename,
+        'registered_at': datetime.now().isoformat(timespec='seconds'),
+        'total_schools': len(special_df),
+        'valid_coordinates': int(dataset['prepared']['valid_mask'].sum()),
+        'sources': {str(source): int(count) for source, count in sources.items()}
+    }
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    
+    reference_datasets[reference_id] = dataset
+    print(f"📚 Registered reference dataset {reference_id}: {original_filename} ({len(special_df)} schools)")
+    return meta
+
+def load_reference_dataset(reference_id):
+    """Load a registered custom dataset (cached per process). Returns None if not registered."""
+    if not is_valid_reference_id(reference_id):
+        return None
+    if reference_id in reference_datasets:
+        return reference_datasets[reference_id]
+    
+    dataset_path = os.path.join(reference_dir(reference_id), 'dataset.pkl')
+    if not os.path.exists(dataset_path):
+        return None
+    
+    stored = pd.read_pickle(dataset_path)
+    dataset = {key: value for key, value in stored.items() if key != 'spatial_index_state'}
+    dataset['spatial_index'] = restore_spatial_index(stored['index_type'], stored['spatial_index_state'])
+    reference_datasets[reference_id] = dataset
+    return dataset
+
+def list_reference_datasets():
+    """Metadata of all registered reference datasets, newest first"""
+    references = []
+    if os.path.isdir(app.config['REFERENCE_FOLDER']):
+        for reference_id in os.listdir(app.config['REFERENCE_FOLDER']):
+            meta_path = os.path.join(reference_dir(reference_id), 'meta.json')
+            if is_valid_reference_id(reference_id) and os.path.exists(meta_path):
+                with open(meta_path, 'r') as f:
+                    references.append(json.load(f))
+    return sorted(references, key=lambda meta: meta['registered_at'], reverse=True)
+
+# Bump when the result rows/summary/report layout changes so older cached analyses are not reused
+RESULT_CACHE_VERSION = 2
+
+def result_cache_key(gov_hash, custom_hash, options=None):
+    """
+    Cache key of a finished analysis: both input file hashes plus every parameter that
+    affects the output (options as returned by parse_analysis_options)
+    """
+    options = options or {}
+    key_data = {
+        'version': RESULT_CACHE_VERSION,
+        'gov': gov_hash,
+        'custom': custom_hash,
+        'mode': options.get('mode', 'radius'),
+        'k': options.get('k'),
+        'radius_km': options.get('radius_km', SEARCH_RADIUS_KM),
+        'rings': list(options.get('rings') or default_rings(options.get('radius_km', SEARCH_RADIUS_KM)))
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()[:32]
+
+def result_cache_dir(cache_key):
+    return os.path.join(app.config['RESULT_CACHE_FOLDER'], cache_key)
+
+def load_cached_result(cache_key):
+    """
+    Finished analysis for cache_key, or None.
+    meta.json is written last, so a directory without it is an incomplete entry.
+    """
+    cache_dir = result_cache_dir(cache_key)
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        results, summary = read_results_state(os.path.join(cache_dir, 'results.pkl'))
+        cached = {
+            'results': results,
+            'summary': summary,
+            'total': meta['total'],
+            'results_state_file': os.path.relpath(os.path.join(cache_dir, 'results.pkl'), app.config['DOWNLOAD_FOLDER'])
+        }
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # Truncated, or pickled by another pandas/Python version - drop the entry and analyze again
+        print(f"⚠️ Unreadable result cache entry {cache_key}: {str(e)}")
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        return None
+    
+    os.utime(cache_dir)  # Mark as recently used
+    return cached
+
+def store_cached_result(cache_key, results, summary, total):
+    """
+    Write a reloadable copy of the results into the result cache. Files are built in a
+    temporary directory and moved into place at the end. Exports are not cached - they are
+    written with each session's own files when first downloaded (see prepare_export).
+    """
+    cache_dir = result_cache_dir(cache_key)
+    tmp_dir = f"{cache_dir}.{threading.get_ident()}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    
+    write_results_state(results, summary, os.path.join(tmp_dir, 'results.pkl'))
+    
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({'cache_key': cache_key, 'created': time.time(), 'total': total, 'rows': len(results)}, f)
+    
+    try:
+        os.replace(tmp_dir, cache_dir)
+    except OSError:
+        if os.path.exists(os.path.join(cache_dir, 'meta.json')):
+            # Same analysis finished concurrently - keep the entry that is already in place
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        else:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            os.replace(tmp_dir, cache_dir)
+    
+    evict_result_cache(keep=cache_key)
+
+def parquet_available():
+    """Whether pandas has a Parquet engine (pyarrow or fastparquet) installed"""
+    try:
+        pd.io.parquet.get_engine('auto')
+        return True
+    except ImportError:
+        return False
+
+def write_results_parquet(results, summary, output_path):
+    """
+    Write all result rows (RESULT_COLUMNS) as a compressed Parquet file.
+    Arrow needs one type per column, so object columns with mixed values are stored as text.
+    """
+    frame = results.to_frame()
+    for col in frame.columns:
+        if frame[col].dtype == object:
+            values = frame[col]
+            if not values.map(lambda value: isinstance(value, str) or value is None).all():
+                frame[col] = values.where(values.isna(), values.astype(str)).astype(object)
+    frame.to_parquet(output_path, index=False, compression='zstd')
+
+def write_results_json(results, summary, output_path):
+    """Write all result rows and the summary as the (indented) results JSON file"""
+    with open(output_path, 'w') as f:
+        json.dump({'results': results.to_json_records(), 'summary': make_json_serializable(summary)}, f, indent=2)
+
+# Rows written per block by the CSV, GeoJSON and SQLite exports
+EXPORT_BLOCK_ROWS = 20000
+
+def write_results_csv(results, summary, output_path):
+    """Write all result rows (RESULT_COLUMNS) as CSV, block by block from the result arrays"""
+    with open(output_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(RESULT_COLUMNS)
+        for start in range(0, len(results), EXPORT_BLOCK_ROWS):
+            columns = results.json_column_block(start, start + EXPORT_BLOCK_ROWS)
+            writer.writerows(zip(*columns))
+
+def write_results_geojson(results, summary, output_path):
+    """
+    Write the matches as a GeoJSON FeatureCollection: one LineString per match from the
+    government school to the custom school, with the result columns as properties
+    """
+    lon_lat = [RESULT_COLUMNS.index(col) for col in ('gov_longitude', 'gov_latitude', 'custom_longitude', 'custom_latitude')]
+    with open(output_path, 'wb') as f:
+        f.write(b'{"type":"FeatureCollection","features":[')
+        for start in range(0, len(results), EXPORT_BLOCK_ROWS):
+            columns = results.json_column_block(start, start + EXPORT_BLOCK_ROWS)
+            features = []
+            for values in zip(*columns):
+                gov_lon, gov_lat, custom_lon, custom_lat = (values[i] for i in lon_lat)
+                geometry = None
+                if None not in (gov_lon, gov_lat, custom_lon, custom_lat):
+                    geometry = {'type': 'LineString', 'coordinates': [[gov_lon, gov_lat], [custom_lon, custom_lat]]}
+                features.append(dumps_json({'type': 'Feature', 'geometry': geometry,
+                                            'properties': dict(zip(RESULT_COLUMNS, values))}))
+            f.write((b',' if start else b'') + b','.join(features))
+        f.write(b']}')
+
+def write_results_sqlite(results, summary, output_path):
+    """
+    Write a SQLite database for GIS use: gov_schools and custom_schools point tables (with
+    latitude/longitude and an R*Tree spatial index where SQLite supports it), the matches as
+    edges between them, a results view with the usual result columns and the summary.
+    """
+    converted = results.json_columns()
+    conn = sqlite3.connect(output_path)
+    try:
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        try:
+            conn.execute('CREATE VIRTUAL TABLE rtree_probe USING rtree(id, min_x, max_x)')
+            conn.execute('DROP TABLE rtree_probe')
+            has_rtree = True
+        except sqlite3.OperationalError:
+            has_rtree = False
+        
+        for table, frame, prefix in (('gov_schools', results.gov_frame, 'gov'), ('custom_schools', results.custom_frame, 'custom')):
+            columns = list(frame.columns)
+            conn.execute(f"CREATE TABLE {table} (id INTEGER PRIMARY KEY, {', '.join(columns)})")
+            conn.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * (len(columns) + 1))})",
+                             zip(range(len(frame)), *(converted[col] for col in columns)))
+            
+            lat_col, lon_col = f"{prefix}_latitude", f"{prefix}_longitude"
+            if has_rtree:
+                conn.execute(f"CREATE VIRTUAL TABLE {table}_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)")
+                conn.execute(f"INSERT INTO {table}_rtree SELECT id, {lat_col}, {lat_col}, {lon_col}, {lon_col} "
+                             f"FROM {table} WHERE {lat_col} IS NOT NULL AND {lon_col} IS NOT NULL")
+            else:
+                conn.execute(f"CREATE INDEX {table}_location ON {table} ({lat_col}, {lon_col})")
+        
+        conn.execute('CREATE TABLE matches (gov_id INTEGER NOT NULL REFERENCES gov_schools (id), '
+                     'custom_id INTEGER NOT NULL REFERENCES custom_schools (id), distance_km REAL, ring TEXT)')
+        conn.executemany('INSERT INTO matches VALUES (?, ?, ?, ?)',
+                         zip(results.gov_idx.tolist(), results.custom_idx.tolist(),
+                             json_safe_values(results.distance_km), results.ring_column()))
+        conn.execute('CREATE INDEX matches_gov ON matches (gov_id)')
+        conn.execute('CREATE INDEX matches_custom ON matches (custom_id)')
+        
+        result_columns = ', '.join(
+            f"m.{col}" if col in ('distance_km', 'ring') else
+            '(SELECT COUNT(*) FROM matches c WHERE c.gov_id = m.gov_id) AS custom_schools_count' if col == 'custom_schools_count' else
+            f"{'g' if col in results.gov_frame.columns else 'c'}.{col}"
+            for col in RESULT_COLUMNS)
+        conn.execute(f"CREATE VIEW results AS SELECT {result_columns} FROM matches m "
+                     'JOIN gov_schools g ON g.id = m.gov_id JOIN custom_schools c ON c.id = m.custom_id ORDER BY m.rowid')
+        
+        conn.execute('CREATE TABLE summary (metric TEXT PRIMARY KEY, value)')
+        conn.executemany('INSERT INTO summary VALUES (?, ?)',
+                         ((key, value if isinstance(value, (int, float, str)) or value is None else json.dumps(value))
+                          for key, value in make_json_serializable(summary).items()))
+        conn.commit()
+    finally:
+        conn.close()
+
+def write_excel_report(results, summary, output_path):
+    create_excel_report(results, summary, output_path)
+    if not os.path.exists(output_path):
+        raise RuntimeError('Excel report could not be created')
+
+# Download types: file name in DOWNLOAD_FOLDER (also the download name) and the function writing it.
+# Exports are session files, so the janitor expires them with the session.
+EXPORT_TYPES = {
+    'excel': ('distance_analysis_{session_id}.xlsx', write_excel_report),
+    'json': ('results_{session_id}.json', write_results_json),
+    'parquet': ('results_{session_id}.parquet', write_results_parquet),
+    'csv': ('results_{session_id}.csv', write_results_csv),
+    'geojson': ('results_{session_id}.geojson', write_results_geojson),
+    'sqlite': ('results_{session_id}.sqlite', write_results_sqlite)
+}
+EXPORT_STALE_SECONDS = 15 * 60  # A 'preparing' marker older than this is from a crashed worker
+
+def process_alive(pid):
+    """Whether a process with this pid is running on this host"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Exists, owned by another user
+    return True
+
+def export_marker_active(marker):
+    """
+    Whether a '.preparing' marker belongs to an export still being written: younger than
+    EXPORT_STALE_SECONDS and its owner process (the pid inside) still alive. A marker left
+    by a web worker that was restarted mid-export is stale right away.
+    """
+    try:
+        age = time.time() - os.path.getmtime(marker)
+        with open(marker, 'r') as f:
+            owner = f.read().strip()
+    except FileNotFoundError:
+        return False
+    if age >= EXPORT_STALE_SECONDS:
+        return False
+    # Empty while the creating worker has not written its pid yet
+    return not owner.isdigit() or process_alive(int(owner))
+
+def export_path(session_id, file_type):
+    """(path of a session's export file, download name)"""
+    download_name = EXPORT_TYPES[file_type][0].format(session_id=session_id)
+    return os.path.join(app.config['DOWNLOAD_FOLDER'], download_name), download_name
+
+def export_status(session_id, file_type):
+    """'ready', 'preparing', 'error' or 'missing' (not generated yet)"""
+    path, _ = export_path(session_id, file_type)
+    if os.path.exists(path):
+        return 'ready'
+    if os.path.exists(f"{path}.error"):
+        return 'error'
+    if export_marker_active(f"{path}.preparing"):
+        return 'preparing'
+    return 'missing'
+
+def prepare_export(session_id, file_type):
+    """
+    Start generating a session's export in a background thread, unless it is ready or
+    some worker is already preparing it. The '.preparing' marker file next to the export
+    is how workers agree on that - it holds the pid of the worker writing the export, so a
+    marker whose owner died is taken over (see export_marker_active). The file is written
+    under a temporary name and renamed.
+    """
+    session = session_store.get(session_id)
+    path, _ = export_path(session_id, file_type)
+    marker = f"{path}.preparing"
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        fd = os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if export_marker_active(marker):
+            return
+        try:
+            fd = os.open(marker, os.O_WRONLY | os.O_TRUNC)  # Left behind by a dead worker - take over
+        except FileNotFoundError:
+            return  # Finished just now
+    os.write(fd, str(os.getpid()).encode())
+    os.close(fd)
+    
+    def build():
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        started = time.time()
+        try:
+            results = get_session_results(session_id, session)
+            if results is None:
+                raise ValueError('Results are no longer available')
+            EXPORT_TYPES[file_type][1](results, session.get('summary') or {}, tmp_path)
+            os.replace(tmp_path, path)
+            print(f"📦 {file_type} export for session {session_id} ready in {time.time() - started:.1f}s")
+        except Exception as e:
+            print(f"❌ Error preparing {file_type} export for session {session_id}: {str(e)}")
+            with open(f"{path}.error", 'w') as f:
+                f.write(str(e))
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+        finally:
+            try:
+                os.remove(marker)
+            except FileNotFoundError:
+                pass
+    
+    threading.Thread(target=build, daemon=True).start()
+
+def directory_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+def evict_result_cache(keep=None):
+    """Remove cached analyses older than RESULT_CACHE_MAX_AGE_HOURS, then least recently used ones over RESULT_CACHE_MAX_MB"""
+    cache_root = app.config['RESULT_CACHE_FOLDER']
+    if not os.path.isdir(cache_root):
+        return
+    
+    max_age = app.config['RESULT_CACHE_MAX_AGE_HOURS'] * 3600
+    now = time.time()
+    entries = []
+    for name in os.listdir(cache_root):
+        path = os.path.join(cache_root, name)
+        meta_path = os.path.join(path, 'meta.json')
+        if name == keep or not os.path.exists(meta_path):
+            continue
+        try:
+            with open(meta_path, 'r') as f:
+                created = json.load(f)['created']
+            entries.append((os.stat(path).st_mtime, directory_size(path), created, path))
+        except (OSError, ValueError, KeyError):
+            continue
+    
+    evicted = 0
+    remaining = []
+    for last_used, size, created, path in entries:
+        if now - created > max_age:
+            shutil.rmtree(path, ignore_errors=True)
+            evicted += 1
+        else:
+            remaining.append((last_used, size, path))
+    
+    budget = app.config['RESULT_CACHE_MAX_MB'] * 1024 * 1024
+    used = sum(size for _, size, _ in remaining)
+    if keep and os.path.isdir(result_cache_dir(keep)):
+        used += directory_size(result_cache_dir(keep))
+    for _, size, path in sorted(remaining):
+        if used <= budget:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        used -= size
+        evicted += 1
+    
+    if evicted:
+        print(f"🗑️ Evicted {evicted} cached analyses")
+
+def process_analysis_background(session_id, gov_path, special_path, reference_id=None, special_filename=None,
+                                options=None):
     """
     Process analysis in background and update session data progressively
+    With reference_id, the custom schools come from the reference dataset registry;
+    if special_path is given as well it is registered first (save for re-use)
+    options holds the search mode, radius, k and distance rings (see parse_analysis_options)
     """
+    options = options or {}
+    cancel_token = CancellationToken(session_id, app.config['ANALYSIS_TIMEOUT_SECONDS'])
     try:
+        # Cancelled while waiting in the queue
+        cancel_token.check()
+        
         # Update session status (already initialized in upload route)
-        if session_id in analysis_sessions:
-            analysis_sessions[session_id]['status'] = 'reading_files'
+        session_store.update(session_id, status='reading_files')
+        
+        # Identify inputs by content - an identical analysis is served from the result cache
+        gov_hash = hash_file(gov_path)
+        if reference_id:
+            if special_path:
+                register_reference_dataset(special_path, special_filename or os.path.basename(special_path))
+            meta = reference_meta(reference_id)
+            if meta is None:
+                raise ValueError(f"Reference dataset {reference_id} is not registered")
+            custom_hash = meta.get('sha256', reference_id)
+        else:
+            custom_hash = hash_file(special_path)
+        
+        cache_key = result_cache_key(gov_hash, custom_hash, options)
+        cached = load_cached_result(cache_key)
+        if cached is not None:
+            # The session keeps its own link to the results - the cache entry may be evicted any time
+            results_state_file = f"results_{session_id}.pkl"
+            state_path = os.path.join(app.config['DOWNLOAD_FOLDER'], results_state_file)
+            cached_path = os.path.join(app.config['DOWNLOAD_FOLDER'], cached['results_state_file'])
+            try:
+                if os.path.exists(results_arrays_path(cached_path)):
+                    os.link(results_arrays_path(cached_path), results_arrays_path(state_path))
+                os.link(cached_path, state_path)
+            except OSError:
+                # Never write through a link that did succeed - it is the cache entry's file
+                for path in (state_path, results_arrays_path(state_path)):
+                    if os.path.exists(path):
+                        os.remove(path)
+                write_results_state(cached['results'], cached['summary'], state_path)
+            session_store.update(session_id, status='completed', summary=cached['summary'],
+                                 progress=cached['total'], total=cached['total'],
+                                 results_count=len(cached['results']),
+                                 results_state_file=results_state_file,
+                                 results_file=f"results_{session_id}.json",
+                                 excel_file=f"distance_analysis_{session_id}.xlsx")
+            print(f"⚡ Session {session_id} served from result cache {cache_key}: {len(cached['results'])} results")
+            return
         
         # Read files
-        gov_df = read_excel_or_csv(gov_path)
-        special_df = read_excel_or_csv(special_path)
+        cancel_token.check()
+        gov_df = read_excel_or_csv(gov_path, gov_hash)
+        custom_dataset = None
+        if reference_id:
+            custom_dataset = load_reference_dataset(reference_id)
+            if custom_dataset is None:
+                raise ValueError(f"Reference dataset {reference_id} is not registered")
+            special_df = custom_dataset['special_df']
+            print(f"📚 Using reference dataset {reference_id} - custom file parsing skipped")
+        else:
+            special_df = read_excel_or_csv(special_path, custom_hash)
         
         # Log source breakdown
         special_mapping = get_column_mapping(special_df, 'custom')
@@ -675,136 +2510,387 @@ def process_analysis_background(session_id, gov_path, special_path):
                 print(f"  {source}: {count} schools")
             print("=" * 35 + "\n")
         
-        if session_id in analysis_sessions:
-            analysis_sessions[session_id]['total'] = len(gov_df)  # Total government schools
-            analysis_sessions[session_id]['status'] = 'analyzing'
+        cancel_token.check()
+        session_store.update(session_id, status='analyzing', total=len(gov_df))  # Total government schools
         
         def progress_callback(sid, result, processed, total):
-            if sid in analysis_sessions:
-                if result is not None:
-                    analysis_sessions[sid]['results'].append(result)
-                analysis_sessions[sid]['progress'] = processed
-                analysis_sessions[sid]['total'] = total
+            if result is not None:
+                session_store.add_live_result(sid, result, progress=processed, total=total)
+            else:
+                session_store.update(sid, progress=processed, total=total)
         
         # Perform analysis with progress updates
-        results = analyze_distances(gov_df, special_df, session_id, progress_callback)
+        results = analyze_distances(gov_df, special_df, session_id, progress_callback, custom_dataset=custom_dataset,
+                                    cancel_token=cancel_token, radius_km=options.get('radius_km'),
+                                    rings=options.get('rings'), mode=options.get('mode', 'radius'),
+                                    k=options.get('k') or 1)
         summary = generate_summary_statistics(results)
+        cancel_token.check()
         
-        # Update session with final results
-        analysis_sessions[session_id]['status'] = 'completed'
-        analysis_sessions[session_id]['results'] = results
-        analysis_sessions[session_id]['summary'] = summary
-        analysis_sessions[session_id]['progress'] = len(gov_df)  # Total government schools processed
+        # Results go to disk - web workers load them on first use - then completion is published
+        results_state_file = f"results_{session_id}.pkl"
+        write_results_state(results, summary, os.path.join(app.config['DOWNLOAD_FOLDER'], results_state_file))
+        # Exports (JSON, Excel, Parquet, ...) are generated next to it on first download
+        store_cached_result(cache_key, results, summary, len(gov_df))
+        session_store.update(session_id, status='completed', summary=summary,
+                             progress=len(gov_df),  # Total government schools processed
+                             results_count=len(results), results_state_file=results_state_file,
+                             excel_file=f"distance_analysis_{session_id}.xlsx", results_file=f"results_{session_id}.json")
         
         print(f"Session {session_id} completed: {len(results)} results from {len(gov_df)} schools")
         
-        # Save final results to JSON
-        results_filename = f"results_{session_id}.json"
-        results_path = os.path.join(app.config['DOWNLOAD_FOLDER'], results_filename)
-        
-        with open(results_path, 'w') as f:
-            json_safe_data = {
-                'results': make_json_serializable(results),
-                'summary': make_json_serializable(summary)
-            }
-            json.dump(json_safe_data, f, indent=2)
-        
-        # Create Excel report
-        excel_filename = f"distance_analysis_{session_id}.xlsx"
-        excel_path = os.path.join(app.config['DOWNLOAD_FOLDER'], excel_filename)
-        create_excel_report(results, summary, excel_path)
-        
-        analysis_sessions[session_id]['excel_file'] = excel_filename
-        analysis_sessions[session_id]['results_file'] = results_filename
-        
+    except AnalysisCancelled as e:
+        print(f"🛑 Session {session_id} cancelled: {e}")
+        session_store.update(session_id, status='cancelled', error=str(e))
+        cleanup_session_files(session_id, gov_path, special_path)
     except Exception as e:
         print(f"Error in session {session_id}: {str(e)}")
         import traceback
         traceback.print_exc()
-        if session_id in analysis_sessions:
-            analysis_sessions[session_id]['status'] = 'error'
-            analysis_sessions[session_id]['error'] = str(e)
+        if session_id in session_store:
+            session_store.update(session_id, status='error', error=str(e))
+
+def cleanup_session_files(session_id, *upload_paths):
+    """Remove a session's uploaded files and results file, and drop its results from this process"""
+    with session_results_lock:
+        session_results.pop(session_id, None)
+    paths = [path for path in upload_paths if path]
+    state_path = os.path.join(app.config['DOWNLOAD_FOLDER'], f"results_{session_id}.pkl")
+    paths += [state_path, results_arrays_path(state_path)]
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def get_analysis_executor():
+    """
+    The process pool for analyses, (re)created after a fork so each web worker owns its pool,
+    and replaced once broken - a worker process that dies (e.g. OOM-killed) breaks the whole pool
+    """
+    global analysis_executor, analysis_executor_pid
+    with analysis_executor_lock:
+        if analysis_executor is not None and analysis_executor_pid == os.getpid() and analysis_executor._broken:
+            print(f"⚠️ Analysis process pool broken ({analysis_executor._broken}) - starting a new one")
+            analysis_executor.shutdown(wait=False, cancel_futures=True)
+            analysis_executor = None
+        if analysis_executor is None or analysis_executor_pid != os.getpid():
+            analysis_executor = ProcessPoolExecutor(max_workers=app.config['ANALYSIS_WORKERS'])
+            analysis_executor_pid = os.getpid()
+            print(f"⚙️ Analysis process pool started with {app.config['ANALYSIS_WORKERS']} workers")
+        return analysis_executor
+
+def submit_analysis(session_id, *args, retries=1):
+    """
+    Queue an analysis job. A job that dies with its worker process is marked as failed; when
+    the pool broke because of another job and this one had not started yet (still 'queued'),
+    it is submitted again to a fresh pool (up to retries times).
+    """
+    def job_done(future):
+        error = future.exception()
+        if error is None:
+            return
+        if isinstance(error, BrokenProcessPool) and retries > 0:
+            session = session_store.get(session_id)
+            if session is not None and session['status'] == 'queued':
+                print(f"🔁 Session {session_id}: analysis pool broke before the job started - requeued")
+                submit_analysis(session_id, *args, retries=retries - 1)
+                return
+        print(f"Error in session {session_id}: analysis worker failed: {error}")
+        session_store.update(session_id, status='error', error=f"Analysis worker failed: {error}")
+    
+    try:
+        future = get_analysis_executor().submit(process_analysis_background, session_id, *args)
+    except BrokenProcessPool:
+        # Broke between the check and the submit - the next call starts a new pool
+        future = get_analysis_executor().submit(process_analysis_background, session_id, *args)
+    future.add_done_callback(job_done)
+    return future
+
+def get_session_results(session_id, session=None):
+    """
+    ColumnarResults of a completed session, or None when its results file is gone or unreadable.
+    Loaded from the session's results file the first time this process needs them (the
+    analysis may have run in another worker); the janitor drops idle ones from memory again.
+    """
+    with session_results_lock:
+        if session_id in session_results:
+            results, size, _ = session_results.pop(session_id)
+            session_results[session_id] = (results, size, time.time())
+            return results
+    
+    session = session or session_store.get(session_id)
+    if session is None or not session.get('results_state_file'):
+        return None
+    try:
+        results, _ = read_results_state(os.path.join(app.config['DOWNLOAD_FOLDER'], session['results_state_file']))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # Truncated, or written by another pandas/Python version - answered like expired results
+        print(f"⚠️ Unreadable results file of session {session_id}: {str(e)}")
+        return None
+    with session_results_lock:
+        session_results[session_id] = (results, results.memory_usage(), time.time())
+    return results
+
+def evict_session_results():
+    """Drop loaded results idle for RESULTS_MEMORY_TTL_MINUTES, then least recently used ones over RESULTS_MEMORY_BUDGET_MB"""
+    idle_cutoff = time.time() - app.config['RESULTS_MEMORY_TTL_MINUTES'] * 60
+    budget = app.config['RESULTS_MEMORY_BUDGET_MB'] * 1024 * 1024
+    evicted = 0
+    with session_results_lock:
+        for session_id, (_, _, last_access) in list(session_results.items()):
+            if last_access < idle_cutoff:
+                del session_results[session_id]
+                evicted += 1
+        used = sum(size for _, size, _ in session_results.values())
+        while session_results and used > budget:
+            _, (_, size, _) = session_results.popitem(last=False)
+            used -= size
+            evicted += 1
+    return evicted
+
+def session_file_paths(session_id):
+    """Files in uploads/ and downloads/ that belong to one session (not the shared caches)"""
+    paths = []
+    for folder in (app.config['UPLOAD_FOLDER'], app.config['DOWNLOAD_FOLDER']):
+        if not os.path.isdir(folder):
+            continue
+        for entry in os.scandir(folder):
+            if entry.is_file() and session_id in entry.name:
+                paths.append(entry.path)
+    return paths
+
+def expire_session(session_id):
+    """Forget a session completely: its store entry, loaded results and files. Returns (files, bytes) removed."""
+    with session_results_lock:
+        session_results.pop(session_id, None)
+    files = freed = 0
+    for path in session_file_paths(session_id):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            files += 1
+            freed += size
+        except FileNotFoundError:
+            pass
+    session_store.delete(session_id)
+    return files, freed
+
+def session_files_usage():
+    """Bytes used by per-session files in uploads/ and downloads/ (caches and the registry excluded)"""
+    used = 0
+    for folder in (app.config['UPLOAD_FOLDER'], app.config['DOWNLOAD_FOLDER']):
+        if os.path.isdir(folder):
+            used += sum(entry.stat().st_size for entry in os.scandir(folder)
+                        if entry.is_file() and not entry.name.startswith('sessions.db'))
+    return used
+
+def run_janitor():
+    """
+    One janitor pass: fail queued sessions whose web worker is gone, expire sessions idle
+    longer than SESSION_TTL_HOURS, then the oldest finished sessions while session files
+    exceed SESSION_FILES_BUDGET_MB, trim the loaded results of this process and enforce
+    the upload/result cache budgets.
+    Counts are added to the shared counters shown at /api/janitor.
+    """
+    counts = {'janitor_runs': 1, 'sessions_expired': 0, 'files_deleted': 0, 'bytes_freed': 0, 'sessions_orphaned': 0}
+    
+    # A queued job lives in its web worker's analysis pool - it never runs once that worker died
+    for session_id, owner_pid in session_store.queued_sessions():
+        if owner_pid and not process_alive(owner_pid):
+            if session_store.fail_queued(session_id, 'The server restarted before this analysis started. Please upload again.'):
+                counts['sessions_orphaned'] += 1
+    
+    expired = session_store.sessions_before(time.time() - app.config['SESSION_TTL_HOURS'] * 3600)
+    budget = app.config['SESSION_FILES_BUDGET_MB'] * 1024 * 1024
+    used = session_files_usage()
+    if used > budget:
+        for session_id in session_store.finished_sessions():
+            if used <= budget:
+                break
+            if session_id not in expired:
+                expired.append(session_id)
+                used -= sum(os.path.getsize(path) for path in session_file_paths(session_id))
+    
+    for session_id in expired:
+        files, freed = expire_session(session_id)
+        counts['sessions_expired'] += 1
+        counts['files_deleted'] += files
+        counts['bytes_freed'] += freed
+    
+    counts['results_evicted_from_memory'] = evict_session_results()
+    if os.path.isdir(app.config['PARSED_CACHE_FOLDER']):
+        evict_parsed_cache()
+    evict_result_cache()
+    
+    session_store.increment_counters(**counts)
+    if counts['sessions_orphaned']:
+        print(f"🧹 Janitor: {counts['sessions_orphaned']} queued sessions failed (their web worker stopped)")
+    if counts['sessions_expired'] or counts['results_evicted_from_memory']:
+        print(f"🧹 Janitor: {counts['sessions_expired']} sessions expired ({counts['files_deleted']} files, "
+              f"{counts['bytes_freed'] / 1024 / 1024:.1f} MB), {counts['results_evicted_from_memory']} results dropped from memory")
+    return counts
+
+def janitor_loop():
+    while True:
+        time.sleep(app.config['JANITOR_INTERVAL_SECONDS'])
+        try:
+            run_janitor()
+        except Exception as e:
+            print(f"Janitor error: {str(e)}")
+
+def ensure_janitor():
+    """Start the janitor thread once per web worker process"""
+    global janitor_pid
+    with janitor_lock:
+        if janitor_pid != os.getpid():
+            janitor_pid = os.getpid()
+            thread = threading.Thread(target=janitor_loop, daemon=True)
+            thread.start()
+
+# Detailed Analysis sheet: (header, result key, how the value is written)
+# 'text' -> str(value), 'value' -> as is, 'distance' -> rounded to 2 decimals
+EXCEL_DETAIL_COLUMNS = [
+    ('Government_School_Name', 'gov_school_name', 'text'),
+    ('Government_BemisCode', 'gov_bemis_code', 'text'),
+    ('Government_District', 'gov_district', 'text'),
+    ('Government_Tehsil', 'gov_tehsil', 'text'),
+    ('Government_UC', 'gov_uc', 'text'),
+    ('Government_Level', 'gov_level', 'text'),
+    ('Government_Gender', 'gov_gender', 'text'),
+    ('Government_Enrollment', 'gov_enrollment', 'value'),
+    ('Government_Latitude', 'gov_latitude', 'value'),
+    ('Government_Longitude', 'gov_longitude', 'value'),
+    ('Government_Space_for_new_Rooms', 'gov_space_for_rooms', 'text'),
+    ('Government_Total_Rooms', 'gov_total_rooms', 'text'),
+    ('Government_Toilets', 'gov_toilets', 'text'),
+    ('Government_Boundary_Wall', 'gov_boundary_wall', 'text'),
+    ('Government_Drinking_Water', 'gov_drinking_water', 'text'),
+    ('Custom_School_Name', 'custom_school_name', 'text'),
+    ('Custom_BemisCode', 'custom_bemis_code', 'text'),
+    ('Custom_Source', 'custom_source', 'text'),
+    ('Custom_Division', 'custom_division', 'text'),
+    ('Custom_District', 'custom_district', 'text'),
+    ('Custom_Tehsil', 'custom_tehsil', 'text'),
+    ('Custom_Level', 'custom_level', 'text'),
+    ('Custom_Gender', 'custom_gender', 'text'),
+    ('Custom_Students', 'custom_students', 'value'),
+    ('Custom_Functional_Status', 'custom_functional_status', 'text'),
+    ('Custom_Latitude', 'custom_latitude', 'value'),
+    ('Custom_Longitude', 'custom_longitude', 'value'),
+    ('Distance_km', 'distance_km', 'distance'),
+    ('Custom_Schools_Count', 'custom_schools_count', 'value'),
+    ('Distance_Ring', 'ring', 'text')
+]
+EXCEL_MAX_ROWS = 1048576  # Rows per worksheet, including the header
+EXCEL_BLOCK_ROWS = 20000  # Result rows converted at a time
+
+def excel_cell_value(value):
+    """Cell value as pandas' to_excel wrote it: missing -> empty cell, infinity -> 'inf'/'-inf'"""
+    if isinstance(value, float):
+        if value != value:
+            return None
+        if value in (float('inf'), float('-inf')):
+            return 'inf' if value > 0 else '-inf'
+    return value
+
+def excel_column_values(values, kind):
+    """Convert one column of a block of results for the Detailed Analysis sheet"""
+    if kind == 'text':
+        return [str(value) for value in values]
+    if kind == 'distance':
+        return [excel_cell_value(round(value, 2)) if isinstance(value, (int, float)) else 'N/A' for value in values]
+    return [excel_cell_value(value) for value in values]
+
+def current_rss_mb():
+    """Resident memory of this process right now (MB), or None where /proc is not available"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError):
+        return None
 
 def create_excel_report(results, summary, output_path):
-    """Create Excel report with custom schools and their nearby government schools"""
+    """
+    Create Excel report with custom schools and their nearby government schools.
+    Rows are streamed from the result arrays block by block into a write-only workbook,
+    so memory stays flat; results beyond one sheet's row limit continue on extra sheets.
+    """
     try:
+        from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.styles import Alignment, Border, Font, Side
+        
         print(f"📝 Creating Excel report with {len(results)} rows...")
+        started = time.time()
+        # RSS growth over the export, sampled per block (the process-lifetime peak says nothing about this export)
+        start_rss = peak_rss = current_rss_mb()
         
-        # Create DataFrame directly from results for better performance
-        detailed_data = []
-        for r in results:
-            # Format distance properly - keep numeric if possible, otherwise as string
-            distance_value = r.get('distance_km', 'N/A')
-            if isinstance(distance_value, (int, float)):
-                distance_display = round(distance_value, 2)
-            else:
-                distance_display = 'N/A'
-            
-            row = {
-                'Government_School_Name': str(r.get('gov_school_name', 'N/A')),
-                'Government_BemisCode': str(r.get('gov_bemis_code', 'N/A')),
-                'Government_District': str(r.get('gov_district', 'N/A')),
-                'Government_Tehsil': str(r.get('gov_tehsil', 'N/A')),
-                'Government_UC': str(r.get('gov_uc', 'N/A')),
-                'Government_Level': str(r.get('gov_level', 'N/A')),
-                'Government_Gender': str(r.get('gov_gender', 'N/A')),
-                'Government_Enrollment': r.get('gov_enrollment', 'N/A'),
-                'Government_Latitude': r.get('gov_latitude', 'N/A'),
-                'Government_Longitude': r.get('gov_longitude', 'N/A'),
-                'Government_Space_for_new_Rooms': str(r.get('gov_space_for_rooms', 'N/A')),
-                'Government_Total_Rooms': str(r.get('gov_total_rooms', 'N/A')),
-                'Government_Toilets': str(r.get('gov_toilets', 'N/A')),
-                'Government_Boundary_Wall': str(r.get('gov_boundary_wall', 'N/A')),
-                'Government_Drinking_Water': str(r.get('gov_drinking_water', 'N/A')),
-                'Custom_School_Name': str(r.get('custom_school_name', 'N/A')),
-                'Custom_BemisCode': str(r.get('custom_bemis_code', 'N/A')),
-                'Custom_Source': str(r.get('custom_source', 'N/A')),
-                'Custom_Division': str(r.get('custom_division', 'N/A')),
-                'Custom_District': str(r.get('custom_district', 'N/A')),
-                'Custom_Tehsil': str(r.get('custom_tehsil', 'N/A')),
-                'Custom_Level': str(r.get('custom_level', 'N/A')),
-                'Custom_Gender': str(r.get('custom_gender', 'N/A')),
-                'Custom_Students': r.get('custom_students', 'N/A'),
-                'Custom_Functional_Status': str(r.get('custom_functional_status', 'N/A')),
-                'Custom_Latitude': r.get('custom_latitude', 'N/A'),
-                'Custom_Longitude': r.get('custom_longitude', 'N/A'),
-                'Distance_km': distance_display,
-                'Custom_Schools_Count': r.get('custom_schools_count', 0)
-            }
-            detailed_data.append(row)
+        workbook = Workbook(write_only=True)
+        # Header style of pandas' to_excel
+        thin = Side(style='thin')
+        header_font = Font(bold=True)
+        header_border = Border(left=thin, right=thin, top=thin, bottom=thin)
+        header_alignment = Alignment(horizontal='center', vertical='top')
         
-        # Create DataFrames
-        df_detailed = pd.DataFrame(detailed_data)
-        print(f"📊 DataFrame created: {len(df_detailed)} rows, {len(df_detailed.columns)} columns")
+        def add_sheet(title, headers):
+            sheet = workbook.create_sheet(title)
+            row = []
+            for header in headers:
+                cell = WriteOnlyCell(sheet, value=header)
+                cell.font, cell.border, cell.alignment = header_font, header_border, header_alignment
+                row.append(cell)
+            sheet.append(row)
+            return sheet
         
         # Summary data
-        summary_data = {
-            'Metric': [
-                'Total Result Rows',
-                'Total Government Schools',
-                'Total Custom Schools Found (within 5km)',
-                'Average Distance (km)',
-                'Average Custom Schools per Government School'
-            ],
-            'Value': [
-                summary.get('total_rows', 0),
-                summary.get('total_gov_schools', 0),
-                summary.get('total_custom_schools_found', 0),
-                summary.get('avg_distance', 0),
-                summary.get('avg_custom_schools_per_gov', 0)
-            ]
-        }
-        df_summary = pd.DataFrame(summary_data)
+        if summary.get('mode') == 'knn':
+            search_label = f"nearest {summary.get('nearest_k')} per source"
+        else:
+            search_label = f"within {summary.get('radius_km', SEARCH_RADIUS_KM):g}km"
+        summary_rows = [
+            ('Total Result Rows', summary.get('total_rows', 0)),
+            ('Total Government Schools', summary.get('total_gov_schools', 0)),
+            (f"Total Custom Schools Found ({search_label})", summary.get('total_custom_schools_found', 0)),
+            ('Average Distance (km)', summary.get('avg_distance', 0)),
+            ('Average Custom Schools per Government School', summary.get('avg_custom_schools_per_gov', 0))
+        ]
+        summary_sheet = add_sheet('Summary', ['Metric', 'Value'])
+        for metric, value in summary_rows:
+            summary_sheet.append([metric, excel_cell_value(value)])
         
-        # Write to Excel
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df_summary.to_excel(writer, sheet_name='Summary', index=False)
-            df_detailed.to_excel(writer, sheet_name='Detailed Analysis', index=False)
+        # Detailed rows, EXCEL_MAX_ROWS - 1 per sheet: 'Detailed Analysis', 'Detailed Analysis 2', ...
+        headers = [header for header, _, _ in EXCEL_DETAIL_COLUMNS]
+        rows_per_sheet = EXCEL_MAX_ROWS - 1
+        sheet, sheet_rows, sheets = None, rows_per_sheet, 0
+        for start in range(0, len(results), EXCEL_BLOCK_ROWS):
+            block = results.to_frame(start, start + EXCEL_BLOCK_ROWS)
+            columns = [excel_column_values(block[key].tolist(), kind) for _, key, kind in EXCEL_DETAIL_COLUMNS]
+            for row in zip(*columns):
+                if sheet_rows == rows_per_sheet:
+                    sheets += 1
+                    sheet = add_sheet('Detailed Analysis' if sheets == 1 else f'Detailed Analysis {sheets}', headers)
+                    sheet_rows = 0
+                sheet.append(row)
+                sheet_rows += 1
+            if start_rss is not None:
+                peak_rss = max(peak_rss, current_rss_mb())
+        if sheet is None:
+            add_sheet('Detailed Analysis', headers)
+            sheets = 1
+        
+        workbook.save(output_path)
         
         # Verify file was created
         if os.path.exists(output_path):
             file_size = os.path.getsize(output_path)
-            print(f"✅ Excel file created successfully: {output_path} ({file_size:,} bytes)")
+            memory = ''
+            if start_rss is not None:
+                memory = f", RSS +{max(peak_rss, current_rss_mb()) - start_rss:.0f} MB at peak"
+            print(f"✅ Excel file created successfully: {output_path} ({file_size:,} bytes, "
+                  f"{len(results)} rows on {sheets} sheet(s) in {time.time() - started:.1f}s{memory})")
         else:
             print(f"❌ Excel file was NOT created: {output_path}")
             
@@ -813,98 +2899,255 @@ def create_excel_report(results, summary, output_path):
         import traceback
         traceback.print_exc()
 
+@app.before_request
+def start_background_services():
+    ensure_janitor()
+
+@app.route('/api/janitor')
+def get_janitor_stats():
+    """Eviction counters for monitoring, plus the current state of this worker"""
+    with session_results_lock:
+        loaded = len(session_results)
+        loaded_bytes = sum(size for _, size, _ in session_results.values())
+    return jsonify({
+        'counters': session_store.counters(),
+        'worker': {
+            'pid': os.getpid(),
+            'results_in_memory': loaded,
+            'results_memory_mb': round(loaded_bytes / 1024 / 1024, 1),
+            'session_files_mb': round(session_files_usage() / 1024 / 1024, 1)
+        }
+    })
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def parse_analysis_options(form):
+    """
+    Search mode ('radius' or 'knn'), search radius (radius_km), nearest-neighbour count (k)
+    and distance ring boundaries (rings, comma-separated km) from the upload form.
+    radius_km is None in knn mode, k is None in radius mode. In radius mode the rings subdivide
+    the radius (default default_rings(radius_km)) and may not reach beyond it.
+    Raises ValueError with a client-facing message.
+    """
+    mode = form.get('mode', '').strip() or 'radius'
+    radius_text = form.get('radius_km', '').strip()
+    k_text = form.get('k', '').strip()
+    rings_text = form.get('rings', '').strip()
+    if mode not in ANALYSIS_MODES:
+        raise ValueError(f"'mode' must be one of {list(ANALYSIS_MODES)}")
+    try:
+        radius_km = float(radius_text) if radius_text else SEARCH_RADIUS_KM
+        k = int(k_text) if k_text else 1
+        rings = [float(part) for part in rings_text.split(',') if part.strip()] if rings_text else None
+    except ValueError:
+        raise ValueError("'radius_km', 'k' and 'rings' must be numbers (rings comma-separated, e.g. 1,2,5)")
+    
+    max_radius = app.config['MAX_SEARCH_RADIUS_KM']
+    if mode == 'radius' and not 0 < radius_km <= max_radius:
+        raise ValueError(f"'radius_km' must be greater than 0 and at most {max_radius:g}")
+    if mode == 'knn' and not 1 <= k <= MAX_NEAREST_K:
+        raise ValueError(f"'k' must be between 1 and {MAX_NEAREST_K}")
+    if rings is None:
+        rings = list(default_rings(radius_km if mode == 'radius' else None))
+    if not rings or len(rings) > MAX_RINGS or any(ring <= 0 or not np.isfinite(ring) for ring in rings):
+        raise ValueError(f"'rings' must be 1 to {MAX_RINGS} positive distances")
+    if mode == 'radius' and max(rings) > radius_km:
+        raise ValueError(f"'rings' must lie within the search radius ({radius_km:g} km)")
+    if max(rings) > max_radius:
+        raise ValueError(f"'rings' must be at most {max_radius:g} km")
+    return {
+        'mode': mode,
+        'radius_km': radius_km if mode == 'radius' else None,
+        'k': k if mode == 'knn' else None,
+        'rings': sorted(set(rings))
+    }
+
 @app.route('/upload', methods=['POST'])
 def upload_files():
+    session_id = None
     try:
+        # Custom schools come either from an uploaded file or from a registered reference dataset
+        reference_id = request.form.get('reference_id', '').strip()
+        save_reference = request.form.get('save_reference', '').lower() in ('1', 'true', 'on', 'yes')
+        
         # Check if files are present
-        if 'gov_file' not in request.files or 'special_file' not in request.files:
+        if 'gov_file' not in request.files or ('special_file' not in request.files and not reference_id):
             return jsonify({'error': 'Both files are required'}), 400
         
         gov_file = request.files['gov_file']
-        special_file = request.files['special_file']
+        special_file = request.files.get('special_file')
+        if special_file is not None and special_file.filename == '' and reference_id:
+            special_file = None
         
-        if gov_file.filename == '' or special_file.filename == '':
+        if gov_file.filename == '' or (special_file is not None and special_file.filename == ''):
             return jsonify({'error': 'No files selected'}), 400
         
-        if not (allowed_file(gov_file.filename) and allowed_file(special_file.filename)):
+        if not allowed_file(gov_file.filename) or (special_file is not None and not allowed_file(special_file.filename)):
             return jsonify({'error': 'Invalid file type. Please upload CSV or Excel files'}), 400
         
+        if special_file is None and reference_meta(reference_id) is None:
+            return jsonify({'error': 'Reference dataset not found'}), 404
+        
+        try:
+            options = parse_analysis_options(request.form)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # Claim a place in the analysis queue first - when it is full the client should retry later
+        session_id = datetime.now().strftime('%Y%m%d_%H%M%S_%f')  # Unique across concurrent workers
+        if not session_store.create_queued(session_id, app.config['ANALYSIS_QUEUE_SIZE']):
+            response = jsonify({'error': 'Too many analyses are waiting. Please try again in a moment.'})
+            response.headers['Retry-After'] = '30'
+            return response, 429
+        
         # Save uploaded files
-        session_id = datetime.now().strftime('%Y%m%d_%H%M%S')
         gov_filename = secure_filename(f"gov_{session_id}_{gov_file.filename}")
-        special_filename = secure_filename(f"special_{session_id}_{special_file.filename}")
-        
         gov_path = os.path.join(app.config['UPLOAD_FOLDER'], gov_filename)
-        special_path = os.path.join(app.config['UPLOAD_FOLDER'], special_filename)
-        
         gov_file.save(gov_path)
-        special_file.save(special_path)
-        
-        # Initialize session BEFORE starting thread
-        analysis_sessions[session_id] = {
-            'status': 'initializing',
-            'progress': 0,
-            'total': 0,
-            'results': [],
-            'summary': None,
-            'error': None
-        }
         
-        # Start background processing
-        thread = threading.Thread(target=process_analysis_background, args=(session_id, gov_path, special_path))
-        thread.daemon = True
-        thread.start()
+        special_path = None
+        if special_file is not None:
+            special_filename = secure_filename(f"special_{session_id}_{special_file.filename}")
+            special_path = os.path.join(app.config['UPLOAD_FOLDER'], special_filename)
+            special_file.save(special_path)
+            # An uploaded file takes precedence; it is only registered when asked to
+            reference_id = reference_id_for_file(special_path) if save_reference else None
+        session_store.update(session_id, reference_id=reference_id)
+        
+        # Queue the analysis - FIFO, processed by the analysis process pool
+        submit_analysis(session_id, gov_path, special_path, reference_id,
+                        special_file.filename if special_file is not None else None, options)
         
         return jsonify({
             'success': True,
-            'session_id': session_id
+            'session_id': session_id,
+            'reference_id': reference_id,
+            'mode': options['mode'],
+            'radius_km': options['radius_km'],
+            'k': options['k'],
+            'rings': options['rings'],
+            'queue_position': session_store.queue_position(session_id)
         })
         
+    except Exception as e:
+        if session_id is not None:
+            session_store.update(session_id, status='error', error=str(e))
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/reference', methods=['GET'])
+def get_reference_datasets():
+    """List registered reference datasets"""
+    return jsonify({'references': list_reference_datasets()})
+
+@app.route('/api/reference', methods=['POST'])
+def upload_reference_dataset():
+    """Register a custom schools file for re-use across analyses"""
+    try:
+        if 'special_file' not in request.files or request.files['special_file'].filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+        
+        special_file = request.files['special_file']
+        if not allowed_file(special_file.filename):
+            return jsonify({'error': 'Invalid file type. Please upload CSV or Excel files'}), 400
+        
+        os.makedirs(app.config['REFERENCE_FOLDER'], exist_ok=True)
+        upload_path = os.path.join(app.config['REFERENCE_FOLDER'],
+                                   secure_filename(f"upload_{datetime.now().strftime('%Y%m%d_%H%M%S%f')}_{special_file.filename}"))
+        special_file.save(upload_path)
+        try:
+            meta = register_reference_dataset(upload_path, special_file.filename)
+        finally:
+            os.remove(upload_path)
+        
+        return jsonify({'success': True, 'reference': meta})
+    
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/reference/<reference_id>')
+def get_reference_dataset(reference_id):
+    """Metadata of one registered reference dataset"""
+    meta = reference_meta(reference_id)
+    if meta is None:
+        return jsonify({'error': 'Reference dataset not found'}), 404
+    return jsonify(meta)
+
+def parse_event_id(event_id):
+    """Last-Event-ID of the progress stream is '<session version>-<last live result seq>'"""
+    try:
+        version, seq = (int(part) for part in (event_id or '').split('-'))
+        return version, seq
+    except ValueError:
+        return None, 0
+
 @app.route('/progress/<session_id>')
 def progress_stream(session_id):
-    """Server-Sent Events endpoint for progress updates"""
+    """
+    Server-Sent Events endpoint for progress updates
+    Events carry only the fields that changed since the previous event plus newly appended
+    result rows; the stream sleeps until the session changes. A reconnecting client sends
+    Last-Event-ID and gets the rows it missed.
+    """
+    last_version, last_seq = parse_event_id(request.headers.get('Last-Event-ID'))
+    
     def generate():
-        last_status = None
+        version, seq = last_version, last_seq
+        sent = {}  # Field values this connection has already sent
         while True:
-            if session_id in analysis_sessions:
-                session = analysis_sessions[session_id]
-                
-                # Only send if status changed or it's a progress update
-                current_status = session['status']
-                
-                data = {
+            session = session_store.get(session_id)
+            if session is None:
+                yield f"data: {{\"status\": \"waiting\"}}\n\n"
+                session_watcher.wait_for_change(session_id, None, timeout=1)
+                continue
+            
+            if session['version'] != version:
+                fields = {
                     'status': session['status'],
                     'progress': int(session['progress']) if session['progress'] is not None else 0,
                     'total': int(session['total']) if session['total'] is not None else 0,
-                    'results': make_json_serializable(session['results'][-5:]) if len(session['results']) > 0 else [],
-                    'summary': make_json_serializable(session['summary']),
                     'error': session['error']
                 }
+                if session['status'] == 'queued':
+                    fields['queue_position'] = session_store.queue_position(session_id)
+                if session['status'] == 'completed':
+                    fields['summary'] = session['summary']
                 
-                yield f"data: {json.dumps(data)}\n\n"
+                data = {key: value for key, value in fields.items() if key not in sent or sent[key] != value}
+                rows, seq = session_store.live_results_since(session_id, seq)
+                if rows:
+                    data['results'] = rows
                 
-                if session['status'] in ['completed', 'error']:
-                    print(f"SSE stream ending for {session_id}: status={session['status']}")
-                    break
-                    
-                last_status = current_status
-            else:
-                yield f"data: {{\"status\": \"waiting\"}}\n\n"
+                version = session['version']
+                if data:
+                    sent.update(fields)
+                    yield f"id: {version}-{seq}\ndata: {json.dumps(data)}\n\n"
+            
+            if session['status'] in ['completed', 'error', 'cancelled']:
+                print(f"SSE stream ending for {session_id}: status={session['status']}")
+                break
             
-            time.sleep(0.3)  # Update every 300ms (faster updates)
+            if not session_watcher.wait_for_change(session_id, version, timeout=15):
+                yield ": keep-alive\n\n"
     
     response = Response(stream_with_context(generate()), mimetype='text/event-stream')
     response.headers['Cache-Control'] = 'no-cache'
     response.headers['X-Accel-Buffering'] = 'no'
     return response
 
+@app.route('/cancel/<session_id>', methods=['POST'])
+@app.route('/api/session/<session_id>', methods=['DELETE'])
+def cancel_analysis(session_id):
+    """Cancel a queued or running analysis; it reports status 'cancelled' once stopped"""
+    status = session_store.request_cancel(session_id)
+    if status is None:
+        return jsonify({'error': 'Session not found'}), 404
+    if status in ('completed', 'error'):
+        return jsonify({'error': f"Analysis already finished (status: {status})", 'status': status}), 409
+    print(f"🛑 Cancellation requested for session {session_id} (status: {status})")
+    return jsonify({'success': True, 'status': status})
+
 @app.route('/results/<session_id>')
 def results(session_id):
     """Results page - loads immediately and updates progressively"""
@@ -913,22 +3156,25 @@ def results(session_id):
 @app.route('/api/session/<session_id>')
 def get_session_data(session_id):
     """Get current session data - lightweight response for polling"""
-    if session_id in analysis_sessions:
-        session = analysis_sessions[session_id]
-        
+    session = session_store.get(session_id)
+    if session is not None:
         # ALWAYS return a lightweight response - never send all results here
         # The full results are fetched by loadFinalData() from /api/results/
         data = {
             'status': session['status'],
             'progress': int(session['progress']) if session['progress'] is not None else 0,
             'total': int(session['total']) if session['total'] is not None else 0,
-            'results_count': len(session['results']),
+            'results_count': session['results_count'],
             'error': session.get('error')
         }
+        if session['status'] == 'queued':
+            data['queue_position'] = session_store.queue_position(session_id)
         
         # Only include summary for completed sessions
         if session['status'] == 'completed' and session.get('summary'):
-            data['summary'] = make_json_serializable(session['summary'])
+            data['summary'] = session['summary']
+        if session['status'] == 'completed':
+            data['exports'] = {file_type: export_status(session_id, file_type) for file_type in EXPORT_TYPES}
         
         print(f"📡 API session response: status={data['status']}, progress={data['progress']}/{data['total']}, results_count={data['results_count']}")
             
@@ -941,42 +3187,261 @@ def get_session_data(session_id):
 
 @app.route('/download/<session_id>/<file_type>')
 def download(session_id, file_type):
+    """
+    Download an export (excel, json, parquet, csv, geojson or sqlite). Exports are generated the first time they
+    are requested: until the file is ready this answers 202 with status 'preparing'.
+    """
     try:
-        if file_type == 'excel':
-            filename = f"distance_analysis_{session_id}.xlsx"
-        else:
-            filename = f"results_{session_id}.json"
+        if file_type not in EXPORT_TYPES:
+            return f"Unknown download type: {file_type}", 404
+        if file_type == 'parquet' and not parquet_available():
+            return "Parquet export is not available: install pyarrow", 501
+        
+        session = session_store.get(session_id) or {}
+        file_path, download_name = export_path(session_id, file_type)
+        if os.path.exists(file_path):
+            return send_file(file_path, as_attachment=True, download_name=download_name)
+        if session.get('status') != 'completed':
+            return "File not found", 404
+        
+        status = export_status(session_id, file_type)
+        if status == 'error':
+            # Report the failure once; the next request tries again
+            with open(f"{file_path}.error", 'r') as f:
+                error = f.read()
+            os.remove(f"{file_path}.error")
+            return jsonify({'status': 'error', 'error': error}), 500
         
-        file_path = os.path.join(app.config['DOWNLOAD_FOLDER'], filename)
-        return send_file(file_path, as_attachment=True)
+        prepare_export(session_id, file_type)
+        response = jsonify({'status': 'preparing', 'type': file_type})
+        response.status_code = 202
+        response.headers['Retry-After'] = '2'
+        return response
     except Exception as e:
         return f"Error downloading file: {str(e)}", 500
 
+# Results API filters: query parameter -> result column
+RESULT_FILTER_PARAMS = {'source': 'custom_source', 'district': 'gov_district', 'tehsil': 'gov_tehsil'}
+RESULT_QUERY_PARAMS = {'offset', 'limit', 'sort', 'order', 'search', 'min_distance', 'max_distance', *RESULT_FILTER_PARAMS}
+RESULTS_PAGE_SIZE = 100
+RESULTS_MAX_PAGE_SIZE = 1000
+
+# Recent filtered/sorted position lists, so paging through one query does not redo it
+results_query_cache = OrderedDict()
+results_query_cache_lock = threading.Lock()
+RESULTS_QUERY_CACHE_SIZE = 32
+
+def parse_results_query(args):
+    """Validate results API query parameters. Raises ValueError with a client-facing message."""
+    def number(name, cast, minimum=None):
+        value = args.get(name, '').strip()
+        if value == '':
+            return None
+        try:
+            value = cast(value)
+        except ValueError:
+            raise ValueError(f"'{name}' must be a number")
+        if minimum is not None and value < minimum:
+            raise ValueError(f"'{name}' must be at least {minimum}")
+        return value
+    
+    query = {
+        'offset': number('offset', int, 0) or 0,
+        'limit': min(number('limit', int, 1) or RESULTS_PAGE_SIZE, RESULTS_MAX_PAGE_SIZE),
+        'sort': args.get('sort') or None,
+        'order': args.get('order', 'asc').lower(),
+        'search': args.get('search', '').strip() or None,
+        'min_distance': number('min_distance', float),
+        'max_distance': number('max_distance', float),
+        'equals': {}
+    }
+    if query['sort'] is not None and query['sort'] not in RESULT_COLUMNS:
+        raise ValueError(f"Cannot sort by '{query['sort']}'. Available: {RESULT_COLUMNS}")
+    if query['order'] not in ('asc', 'desc'):
+        raise ValueError("'order' must be 'asc' or 'desc'")
+    for param, column in RESULT_FILTER_PARAMS.items():
+        accepted = [value for value in args.getlist(param) if value != '']
+        if accepted:
+            query['equals'][column] = accepted
+    return query
+
+def query_result_positions(session_id, results, query):
+    """Filtered and sorted match positions for a results API query (cached per process)"""
+    cache_key = (session_id, id(results), query['sort'], query['order'], query['search'],
+                 query['min_distance'], query['max_distance'],
+                 tuple(sorted((column, tuple(values)) for column, values in query['equals'].items())))
+    with results_query_cache_lock:
+        if cache_key in results_query_cache:
+            results_query_cache.move_to_end(cache_key)
+            return results_query_cache[cache_key]
+    
+    positions = results.filter_positions(query['equals'], query['search'], query['min_distance'], query['max_distance'])
+    if query['sort']:
+        positions = results.sort_positions(positions, query['sort'], descending=query['order'] == 'desc')
+    
+    with results_query_cache_lock:
+        results_query_cache[cache_key] = positions
+        while len(results_query_cache) > RESULTS_QUERY_CACHE_SIZE:
+            results_query_cache.popitem(last=False)
+    return positions
+
+def completed_session_results(session_id):
+    """(session, ColumnarResults) of a completed session, or (None, error response)"""
+    session = session_store.get(session_id)
+    if session is None:
+        return None, (jsonify({'error': 'Session not found'}), 404)
+    if session['status'] != 'completed':
+        return None, (jsonify({'error': f"Analysis not completed (status: {session['status']})"}), 409)
+    results = get_session_results(session_id, session)
+    if results is None:
+        return None, (jsonify({'error': 'Results are no longer available'}), 410)
+    return session, results
+
+@app.route('/api/results/<session_id>/filters')
+def get_results_filters(session_id):
+    """Values available for the results API filters"""
+    session, results = completed_session_results(session_id)
+    if session is None:
+        return results
+    options = {}
+    for param, column in RESULT_FILTER_PARAMS.items():
+        values, _ = results._school_values(column)
+        options[param] = sorted({str(value) for value in values if not pd.isna(value)}, key=str.lower)
+    return jsonify(options)
+
+@app.route('/api/results/<session_id>/map')
+def get_results_map(session_id):
+    """Unique school locations for the map - one entry per school instead of one per match"""
+    session, results = completed_session_results(session_id)
+    if session is None:
+        return results
+    points = results.map_points()
+    gov = points['gov']
+    custom = points['custom'].rename(columns=lambda col: col[len('custom_'):])
+    return json_response({
+        'gov': frame_to_json_records(gov),
+        'custom': frame_to_json_records(custom)
+    })
+
+# Rows serialized per chunk by the streaming results endpoint
+RESULTS_STREAM_BLOCK_ROWS = 2000
+
+@app.route('/api/results/<session_id>/stream')
+def stream_results_data(session_id):
+    """
+    Stream every result row block by block, so memory stays flat however many rows there are.
+    format=ndjson (default) writes one JSON object per line; format=json writes
+    {"total", "summary", "results": [...]} as a chunked array. The source/district/tehsil/
+    search/distance filters and sort/order of /api/results apply; offset/limit are ignored.
+    The body is gzip-compressed as it is produced when the client accepts gzip.
+    """
+    stream_format = request.args.get('format', 'ndjson').lower()
+    if stream_format not in ('ndjson', 'json'):
+        return jsonify({'error': "'format' must be 'ndjson' or 'json'"}), 400
+    try:
+        query = parse_results_query(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    session, results = completed_session_results(session_id)
+    if session is None:
+        return results
+    
+    positions = query_result_positions(session_id, results, query)
+    summary = session['summary']
+    
+    def generate_chunks():
+        if stream_format == 'json':
+            yield b'{"total":%d,"summary":%s,"results":[' % (len(positions), dumps_json(make_json_serializable(summary)))
+        for start in range(0, len(positions), RESULTS_STREAM_BLOCK_ROWS):
+            records = results.to_json_records(positions=positions[start:start + RESULTS_STREAM_BLOCK_ROWS])
+            if stream_format == 'json':
+                yield (b',' if start else b'') + b','.join(dumps_json(record) for record in records)
+            else:
+                yield b''.join(dumps_json(record) + b'\n' for record in records)
+        if stream_format == 'json':
+            yield b']}'
+    
+    use_gzip = 'gzip' in request.accept_encodings
+    
+    def generate():
+        if not use_gzip:
+            yield from generate_chunks()
+            return
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+        for chunk in generate_chunks():
+            # Sync flush so each block reaches the client as soon as it is serialized
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    
+    mimetype = 'application/x-ndjson' if stream_format == 'ndjson' else 'application/json'
+    response = Response(generate(), mimetype=mimetype)
+    response.headers['X-Total-Count'] = str(len(positions))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
 @app.route('/api/results/<session_id>')
 def get_results_data(session_id):
+    """
+    Analysis results. With any of offset/limit/sort/order/search/source/district/tehsil/
+    min_distance/max_distance one page of filtered, sorted rows is returned with the
+    matching total; without them every row is returned (as before).
+    """
     try:
         print(f"📊 API results requested for session: {session_id}")
         
-        # First check if session is in memory
-        if session_id in analysis_sessions:
-            session = analysis_sessions[session_id]
-            print(f"📊 Session found in memory: status={session['status']}, results_count={len(session['results'])}")
-            if session['status'] == 'completed':
-                print(f"📊 Serializing {len(session['results'])} results...")
+        if RESULT_QUERY_PARAMS & set(request.args):
+            try:
+                query = parse_results_query(request.args)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            session, results = completed_session_results(session_id)
+            if session is None:
+                return results
+            
+            positions = query_result_positions(session_id, results, query)
+            page = positions[query['offset']:query['offset'] + query['limit']]
+            response = json_response({
+                'results': results.to_json_records(positions=page),
+                'total': len(positions),
+                'total_unfiltered': len(results),
+                'offset': query['offset'],
+                'limit': query['limit'],
+                'sort': query['sort'],
+                'order': query['order'],
+                'summary': session['summary']
+            })
+            response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+            return response
+        
+        # First check the session store - results load from the session's results file on first use
+        session = session_store.get(session_id)
+        if session is not None:
+            print(f"📊 Session found: status={session['status']}, results_count={session['results_count']}")
+            results = get_session_results(session_id, session) if session['status'] == 'completed' else None
+            if results is not None:
+                print(f"📊 Serializing {len(results)} results...")
                 data = {
-                    'results': make_json_serializable(session['results']),
-                    'summary': make_json_serializable(session['summary'])
+                    'results': results.to_json_records(),
+                    'summary': session['summary']
                 }
-                # Check response size
-                response = jsonify(data)
+                response = json_response(data)
                 response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
                 response.headers['Pragma'] = 'no-cache'
                 response.headers['Expires'] = '0'
                 print(f"✅ Returning {len(data['results'])} results to frontend")
                 return response
         
-        # Otherwise try to load from file
-        results_path = os.path.join(app.config['DOWNLOAD_FOLDER'], f"results_{session_id}.json")
+        # Otherwise try the results JSON export, if one was downloaded before
+        results_file = (session or {}).get('results_file') or f"results_{session_id}.json"
+        results_path = os.path.join(app.config['DOWNLOAD_FOLDER'], results_file)
+        if not os.path.exists(results_path):
+            if session is not None and session['status'] == 'completed':
+                return jsonify({'error': 'Results are no longer available'}), 410
+            return jsonify({'error': 'Results not found'}), 404
         print(f"Trying to load from file: {results_path}")
         with open(results_path, 'r') as f:
             data = json.load(f)
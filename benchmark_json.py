@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+JSON Serialization Benchmark
+Compares the column-wise result serialization (to_json_records + dumps_json) with
+make_json_serializable(to_records()) + json.dumps on the sample data in test_data/
+
+Usage: python benchmark_json.py [gov_file] [custom_file] [--repeat N]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import time
+
+import app as analysis_app
+
+
+def best_of(func, repeat):
+    """Fastest of several runs (seconds) and the last return value"""
+    best, value = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark result JSON serialization')
+    parser.add_argument('gov_file', nargs='?', default='test_data/Quetta.xlsx')
+    parser.add_argument('custom_file', nargs='?', default='test_data/other.xlsx')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print("\n📊 JSON serialization benchmark")
+    print("=" * 50)
+    with contextlib.redirect_stdout(io.StringIO()):
+        gov_df = analysis_app.read_excel_or_csv(args.gov_file)
+        custom_df = analysis_app.read_excel_or_csv(args.custom_file)
+        results = analysis_app.analyze_distances(gov_df, custom_df)
+    print(f"Rows: {len(results)}  (encoder: {'orjson' if analysis_app.orjson else 'json'})")
+
+    def current():
+        return json.dumps(analysis_app.make_json_serializable(results.to_records()))
+
+    def columnwise():
+        results._json_columns = None  # Include the per-school conversion in every run
+        return analysis_app.dumps_json(results.to_json_records())
+
+    current_time, current_json = best_of(current, args.repeat)
+    columnwise_time, columnwise_json = best_of(columnwise, args.repeat)
+
+    print(f"make_json_serializable + json.dumps: {current_time:.3f}s")
+    print(f"to_json_records + dumps_json:        {columnwise_time:.3f}s  ({current_time / columnwise_time:.1f}x)")
+
+    same = json.loads(current_json) == json.loads(columnwise_json)
+    print(f"Same JSON values: {'✅ yes' if same else '❌ NO'}")
+    return 0 if same else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -8,6 +8,9 @@ document.addEventListener('DOMContentLoaded', function() {
     const specialFileInput = document.getElementById('specialFile');
     const govFileName = document.getElementById('govFileName');
     const specialFileName = document.getElementById('specialFileName');
+    const referenceSelect = document.getElementById('referenceSelect');
+    const saveReference = document.getElementById('saveReference');
+    const modeSelect = document.getElementById('modeSelect');
     const analyzeBtn = document.getElementById('analyzeBtn');
     const resetBtn = document.getElementById('resetBtn');
     const progressSection = document.getElementById('progressSection');
@@ -31,12 +34,39 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
 
+    // Radius search takes a radius, nearest-neighbour search a count per source
+    modeSelect.addEventListener('change', updateModeOptions);
+
+    function updateModeOptions() {
+        const knn = modeSelect.value === 'knn';
+        document.getElementById('radiusOption').style.display = knn ? 'none' : '';
+        document.getElementById('kOption').style.display = knn ? '' : 'none';
+    }
+
+    // Saved reference datasets (custom schools files registered for re-use)
+    loadReferenceDatasets();
+
+    async function loadReferenceDatasets() {
+        try {
+            const response = await fetch('/api/reference');
+            const data = await response.json();
+            (data.references || []).forEach(reference => {
+                const option = document.createElement('option');
+                option.value = reference.reference_id;
+                option.textContent = `${reference.filename} (${reference.total_schools} schools)`;
+                referenceSelect.appendChild(option);
+            });
+        } catch (error) {
+            console.error('Error loading saved datasets:', error);
+        }
+    }
+
     // Form submission
     uploadForm.addEventListener('submit', async function(e) {
         e.preventDefault();
 
         // Validate files
-        if (!govFileInput.files.length || !specialFileInput.files.length) {
+        if (!govFileInput.files.length || (!specialFileInput.files.length && !referenceSelect.value)) {
             showError('Please select both files before analyzing.');
             return;
         }
@@ -56,7 +86,21 @@ document.addEventListener('DOMContentLoaded', function() {
         try {
             const formData = new FormData();
             formData.append('gov_file', govFileInput.files[0]);
-            formData.append('special_file', specialFileInput.files[0]);
+            if (specialFileInput.files.length) {
+                formData.append('special_file', specialFileInput.files[0]);
+                if (saveReference.checked) {
+                    formData.append('save_reference', 'true');
+                }
+            } else {
+                formData.append('reference_id', referenceSelect.value);
+            }
+            formData.append('mode', modeSelect.value);
+            if (modeSelect.value === 'knn') {
+                formData.append('k', document.getElementById('kInput').value);
+            } else {
+                formData.append('radius_km', document.getElementById('radiusInput').value);
+            }
+            formData.append('rings', document.getElementById('ringsInput').value);
 
             progressBar.style.width = '60%';
             progressText.textContent = 'Starting analysis...';
@@ -98,6 +142,7 @@ document.addEventListener('DOMContentLoaded', function() {
         hideError();
         progressSection.style.display = 'none';
         progressBar.style.width = '0%';
+        setTimeout(updateModeOptions, 0);  // After the form has reset the mode select
     });
 
     // Error handling functions
@@ -8,13 +8,57 @@ let analysisData = { results: [], summary: null };
 let eventSource = null;
 let isAnalysisComplete = false;
 let allResults = [];
+let mapPoints = null;
+
+// Server-side table paging, sorting and filtering (/api/results/<id>?offset=...)
+const TABLE_PAGE_SIZE = 100;
+let tableQuery = { offset: 0, limit: TABLE_PAGE_SIZE, sort: null, order: 'asc' };
+let tableTotal = 0;
+let serverPaging = false;
+let tableInitialized = false;
+let tableRequest = 0;
+let searchTimer = null;
 
 document.addEventListener('DOMContentLoaded', function() {
     initializeMap();
     startProgressiveLoading();
     initializeEventHandlers();
+    initializeCancelButton();
 });
 
+// ============================================
+// Cancelling a queued or running analysis
+// ============================================
+
+function initializeCancelButton() {
+    const cancelBtn = document.getElementById('cancelAnalysisBtn');
+    if (!cancelBtn) return;
+
+    cancelBtn.addEventListener('click', async function() {
+        cancelBtn.disabled = true;
+        try {
+            const response = await fetch(`/cancel/${sessionId}`, { method: 'POST' });
+            const data = await response.json();
+            if (!response.ok) {
+                throw new Error(data.error || 'Could not cancel the analysis');
+            }
+            console.log('🛑 Cancellation requested, status:', data.status);
+        } catch (error) {
+            console.error('Cancel error:', error);
+            cancelBtn.disabled = false;
+        }
+    });
+}
+
+function showCancelled(message) {
+    const loadingMessageEl = document.querySelector('.loading-message');
+    if (loadingMessageEl) loadingMessageEl.textContent = message || 'Analysis cancelled';
+    const spinner = document.querySelector('#loadingOverlay .spinner');
+    if (spinner) spinner.style.display = 'none';
+    const cancelBtn = document.getElementById('cancelAnalysisBtn');
+    if (cancelBtn) cancelBtn.style.display = 'none';
+}
+
 // ============================================
 // Progressive Loading with Server-Sent Events
 // ============================================
@@ -27,6 +71,8 @@ function startProgressiveLoading() {
     // Connect to SSE endpoint
     eventSource = new EventSource(`/progress/${sessionId}`);
     let messageCount = 0;
+    // Events only carry changed fields and new result rows - keep the merged state here
+    const streamState = {};
     
     console.log('EventSource created, waiting for data...');
     
@@ -37,7 +83,8 @@ function startProgressiveLoading() {
     eventSource.onmessage = function(event) {
         messageCount++;
         console.log(`SSE message #${messageCount} received:`, event.data);
-        const data = JSON.parse(event.data);
+        const delta = JSON.parse(event.data);
+        const data = Object.assign(streamState, delta, { results: delta.results || [] });
         
         console.log('Parsed data:', {
             status: data.status,
@@ -76,6 +123,10 @@ function startProgressiveLoading() {
             eventSource.close();
             showError(data.error || 'An error occurred during analysis');
             loadingOverlay.classList.add('hidden');
+        } else if (data.status === 'cancelled') {
+            console.log('🛑 Analysis cancelled:', data.error);
+            eventSource.close();
+            showCancelled(data.error);
         }
     };
     
@@ -117,6 +168,14 @@ function updateProgress(data) {
     const percent = data.total > 0 ? Math.round((data.progress / data.total) * 100) : 0;
     if (progressPctEl) progressPctEl.textContent = percent + '%';
     if (progressFillEl) progressFillEl.style.width = percent + '%';
+
+    // Show the queue position while the analysis waits for a free worker
+    const loadingMessageEl = document.querySelector('.loading-message');
+    if (loadingMessageEl) {
+        loadingMessageEl.textContent = data.status === 'queued'
+            ? `Waiting in queue (position ${data.queue_position || 1})...`
+            : 'Calculating distances between schools...';
+    }
     
     // Update results as they come
     if (data.results && data.results.length > 0) {
@@ -186,6 +245,11 @@ function startPolling() {
                     console.log('🎯 Loading overlay hidden');
                 }
                 return; // Exit polling
+            } else if (data.status === 'cancelled') {
+                clearInterval(pollInterval);
+                console.log('🛑 Analysis cancelled:', data.error);
+                showCancelled(data.error);
+                return;
             } else if (data.status === 'error') {
                 clearInterval(pollInterval);
                 console.error('❌ Analysis failed:', data.error);
@@ -209,51 +273,31 @@ function startPolling() {
 async function loadFinalData() {
     console.log('📊 Loading final data for session:', sessionId);
     try {
-        // Try to load from API first
-        const response = await fetch(`/api/results/${sessionId}`);
-        console.log('📊 Final data response status:', response.status, 'type:', response.headers.get('content-type'));
-        
-        if (!response.ok) {
-            console.error('❌ API returned error status:', response.status);
+        // Load the first table page - the rest is fetched page by page as the user browses
+        serverPaging = true;
+        const data = await loadTablePage();
+        if (!data) {
             // Try fallback: download the JSON file directly
             console.log('📥 Trying fallback: loading from JSON file...');
+            serverPaging = false;
             return await loadFromJsonFile();
         }
         
-        // Get response as text first to check for issues
-        const responseText = await response.text();
-        console.log('📊 Response text length:', responseText.length, 'chars');
-        console.log('📊 First 200 chars:', responseText.substring(0, 200));
-        
-        // Try to parse JSON
-        let data;
-        try {
-            data = JSON.parse(responseText);
-            console.log('✅ JSON parsed successfully');
-        } catch (parseError) {
-            console.error('❌ JSON Parse Error:', parseError.message);
-            console.error('📄 Response preview (first 500 chars):', responseText.substring(0, 500));
-            console.error('📄 Response preview (last 500 chars):', responseText.substring(responseText.length - 500));
-            
-            // Try fallback: download the JSON file directly
-            console.log('📥 Trying fallback: loading from JSON file...');
-            return await loadFromJsonFile();
-        }
-        
-        console.log('📊 Final data loaded:', {
-            resultsCount: data.results?.length || 0,
-            summaryExists: !!data.summary,
-            firstResult: data.results?.[0]
-        });
-        
-        analysisData = data;
-        allResults = data.results;
+        analysisData.summary = data.summary;
         
         // Update all displays with final data
         updateSummaryStats(data.summary);
-        renderCompleteTable(data.results);
-        renderCompleteMap(data.results);
         initializeCharts(data.summary);
+        initializeTable();
+        loadTableFilters();
+        
+        const mapResponse = await fetch(`/api/results/${sessionId}/map`);
+        if (mapResponse.ok) {
+            mapPoints = await mapResponse.json();
+            renderMapPoints(mapPoints);
+        } else {
+            console.error('❌ Map points request failed:', mapResponse.status);
+        }
         
         // Enable downloads
         const downloadBtn = document.getElementById('downloadExcelBtn');
@@ -268,9 +312,80 @@ async function loadFinalData() {
     }
 }
 
+function buildTableParams() {
+    const params = new URLSearchParams({ offset: tableQuery.offset, limit: tableQuery.limit, order: tableQuery.order });
+    if (tableQuery.sort) params.set('sort', tableQuery.sort);
+    
+    const fields = {
+        search: 'searchInput',
+        source: 'filterType',
+        district: 'filterDistrict',
+        tehsil: 'filterTehsil',
+        min_distance: 'minDistance',
+        max_distance: 'maxDistance'
+    };
+    Object.entries(fields).forEach(([param, id]) => {
+        const element = document.getElementById(id);
+        const value = element ? element.value.trim() : '';
+        if (value) params.set(param, value);
+    });
+    return params;
+}
+
+async function loadTablePage() {
+    const requestId = ++tableRequest;
+    const response = await fetch(`/api/results/${sessionId}?${buildTableParams()}`);
+    if (!response.ok) {
+        console.error('❌ API returned error status:', response.status);
+        return null;
+    }
+    
+    const data = await response.json();
+    if (requestId !== tableRequest) return data; // A newer query has been sent meanwhile
+    
+    tableTotal = data.total;
+    const tbody = document.getElementById('resultsTableBody');
+    tbody.innerHTML = '';
+    data.results.forEach((result, index) => {
+        tbody.appendChild(createTableRow(result, data.offset + index));
+    });
+    updatePager(data);
+    return data;
+}
+
+function updatePager(data) {
+    const pages = Math.max(1, Math.ceil(data.total / data.limit));
+    const page = Math.floor(data.offset / data.limit) + 1;
+    const pageInfo = document.getElementById('pageInfo');
+    if (pageInfo) {
+        const filtered = data.total !== data.total_unfiltered ? ` (filtered from ${data.total_unfiltered})` : '';
+        pageInfo.textContent = `Page ${page} of ${pages} - ${data.total} rows${filtered}`;
+    }
+    document.getElementById('prevPageBtn').disabled = data.offset <= 0;
+    document.getElementById('nextPageBtn').disabled = data.offset + data.limit >= data.total;
+}
+
+async function loadTableFilters() {
+    const response = await fetch(`/api/results/${sessionId}/filters`);
+    if (!response.ok) return;
+    const options = await response.json();
+    
+    [['filterDistrict', options.district], ['filterTehsil', options.tehsil]].forEach(([id, values]) => {
+        const select = document.getElementById(id);
+        if (!select || !values) return;
+        values.forEach(value => {
+            const option = document.createElement('option');
+            option.value = value;
+            option.textContent = value;
+            select.appendChild(option);
+        });
+    });
+}
+
 async function loadFromJsonFile() {
     console.log('📥 Loading data from JSON file as fallback...');
     try {
+        await waitForExport('json');
         const response = await fetch(`/download/${sessionId}/json`);
         if (!response.ok) {
             throw new Error(`Failed to download JSON file: ${response.status}`);
@@ -404,16 +519,6 @@ function updateMapWithResults(results) {
 }
 
 function renderCompleteMap(results) {
-    // Clear existing markers
-    markers.forEach(marker => map.removeLayer(marker));
-    markers = [];
-    
-    // Create distinct icons
-    const govIcon = createCustomIcon('#14b8a6', 'fa-school');
-    const beacIcon = createCustomIcon('#3b82f6', 'fa-graduation-cap');
-    const nchdIcon = createCustomIcon('#8b5cf6', 'fa-university');
-    const befIcon = createCustomIcon('#ec4899', 'fa-building');
-    
     // Track unique government schools and custom schools
     const govSchools = new Map();
     const customSchools = new Map();
@@ -449,8 +554,23 @@ function renderCompleteMap(results) {
         }
     });
     
+    mapPoints = { gov: Array.from(govSchools.values()), custom: Array.from(customSchools.values()) };
+    renderMapPoints(mapPoints);
+}
+
+function renderMapPoints(points) {
+    // Clear existing markers
+    markers.forEach(marker => map.removeLayer(marker));
+    markers = [];
+    
+    // Create distinct icons
+    const govIcon = createCustomIcon('#14b8a6', 'fa-school');
+    const beacIcon = createCustomIcon('#3b82f6', 'fa-graduation-cap');
+    const nchdIcon = createCustomIcon('#8b5cf6', 'fa-university');
+    const befIcon = createCustomIcon('#ec4899', 'fa-building');
+    
     // Plot government schools - double-check coordinates before plotting
-    govSchools.forEach(result => {
+    points.gov.forEach(result => {
         if (result.gov_latitude && result.gov_longitude &&
             typeof result.gov_latitude === 'number' && typeof result.gov_longitude === 'number') {
             const marker = L.marker([result.gov_latitude, result.gov_longitude], { icon: govIcon })
@@ -461,7 +581,7 @@ function renderCompleteMap(results) {
     });
     
     // Plot custom schools with appropriate icons based on source type
-    customSchools.forEach(school => {
+    points.custom.forEach(school => {
         // Assign icons: BEAC -> blue, NCHD -> purple, BEF -> pink
         let icon;
         if (school.source === 'BEAC') {
@@ -582,43 +702,32 @@ function createDistanceRangeChart(summary) {
     const ctx = document.getElementById('distanceRangeChart');
     if (!ctx) return;
     
+    // Ring labels ('0-2km', '2-5km', ...) as configured for this analysis, innermost first
+    const rings = Object.keys(summary.distance_ranges || summary.beac_distance_ranges || {})
+        .sort((a, b) => parseFloat(a) - parseFloat(b));
+    
     new Chart(ctx.getContext('2d'), {
         type: 'bar',
         data: {
-            labels: ['0-2 km', '2-5 km', '5-10 km', '10+ km'],
+            labels: rings.map(label => label.replace('km', ' km')),
             datasets: [
                 {
                     label: 'BEAC Schools',
-                    data: [
-                        summary.beac_distance_ranges['0-2km'],
-                        summary.beac_distance_ranges['2-5km'],
-                        summary.beac_distance_ranges['5-10km'],
-                        summary.beac_distance_ranges['10+km']
-                    ],
+                    data: rings.map(label => summary.beac_distance_ranges[label] || 0),
                     backgroundColor: 'rgba(59, 130, 246, 0.7)',
                     borderColor: 'rgba(59, 130, 246, 1)',
                     borderWidth: 1
                 },
                 {
                     label: 'NCHD Schools',
-                    data: [
-                        summary.nchd_distance_ranges['0-2km'],
-                        summary.nchd_distance_ranges['2-5km'],
-                        summary.nchd_distance_ranges['5-10km'],
-                        summary.nchd_distance_ranges['10+km']
-                    ],
+                    data: rings.map(label => summary.nchd_distance_ranges[label] || 0),
                     backgroundColor: 'rgba(139, 92, 246, 0.7)',
                     borderColor: 'rgba(139, 92, 246, 1)',
                     borderWidth: 1
                 },
                 {
                     label: 'BEF Schools',
-                    data: [
-                        summary.bef_distance_ranges['0-2km'],
-                        summary.bef_distance_ranges['2-5km'],
-                        summary.bef_distance_ranges['5-10km'],
-                        summary.bef_distance_ranges['10+km']
-                    ],
+                    data: rings.map(label => summary.bef_distance_ranges[label] || 0),
                     backgroundColor: 'rgba(236, 72, 153, 0.7)',
                     borderColor: 'rgba(236, 72, 153, 1)',
                     borderWidth: 1
@@ -700,19 +809,66 @@ function createTypeDistributionChart(summary) {
 // ============================================
 
 function initializeTable() {
-    const searchInput = document.getElementById('searchInput');
-    const filterType = document.getElementById('filterType');
+    if (tableInitialized) return;
+    tableInitialized = true;
     
+    const searchInput = document.getElementById('searchInput');
     if (searchInput) {
-        searchInput.addEventListener('input', filterTable);
+        searchInput.addEventListener('input', () => {
+            // Debounce server-side search while typing
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(filterTable, serverPaging ? 300 : 0);
+        });
     }
     
-    if (filterType) {
-        filterType.addEventListener('change', filterTable);
+    ['filterType', 'filterDistrict', 'filterTehsil', 'minDistance', 'maxDistance'].forEach(id => {
+        const element = document.getElementById(id);
+        if (element) {
+            element.addEventListener('change', filterTable);
+        }
+    });
+    
+    document.querySelectorAll('#resultsTable th.sortable').forEach(th => {
+        th.addEventListener('click', () => sortTable(th.getAttribute('data-sort')));
+    });
+    
+    document.getElementById('prevPageBtn').addEventListener('click', () => changePage(-1));
+    document.getElementById('nextPageBtn').addEventListener('click', () => changePage(1));
+}
+
+function changePage(step) {
+    const offset = tableQuery.offset + step * tableQuery.limit;
+    if (!serverPaging || offset < 0 || offset >= tableTotal) return;
+    tableQuery.offset = offset;
+    loadTablePage();
+}
+
+function sortTable(column) {
+    if (!serverPaging) return;
+    if (tableQuery.sort === column) {
+        tableQuery.order = tableQuery.order === 'asc' ? 'desc' : 'asc';
+    } else {
+        tableQuery.sort = column;
+        tableQuery.order = 'asc';
     }
+    document.querySelectorAll('#resultsTable th.sortable').forEach(th => {
+        th.classList.remove('sort-asc', 'sort-desc');
+        if (th.getAttribute('data-sort') === column) {
+            th.classList.add(`sort-${tableQuery.order}`);
+        }
+    });
+    tableQuery.offset = 0;
+    loadTablePage();
 }
 
 function filterTable() {
+    if (serverPaging) {
+        tableQuery.offset = 0;
+        loadTablePage();
+        return;
+    }
+    
+    // Fallback (results loaded from the JSON file): filter the rendered rows
     const searchValue = document.getElementById('searchInput').value.toLowerCase();
     const filterValue = document.getElementById('filterType').value;
     const rows = document.querySelectorAll('#resultsTableBody tr');
@@ -766,8 +922,38 @@ function initializeEventHandlers() {
     }
 }
 
-function downloadExcel() {
-    window.location.href = `/download/${sessionId}/excel`;
+// Exports are generated on first download - wait while the server is preparing them
+async function waitForExport(fileType) {
+    while (true) {
+        const response = await fetch(`/download/${sessionId}/${fileType}`, { method: 'HEAD' });
+        if (response.status !== 202) {
+            if (!response.ok) {
+                throw new Error(`Failed to prepare ${fileType} download: ${response.status}`);
+            }
+            return;
+        }
+        const retryAfter = parseInt(response.headers.get('Retry-After') || '2', 10);
+        await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+    }
+}
+
+async function downloadExcel() {
+    const formatSelect = document.getElementById('exportFormat');
+    const fileType = formatSelect ? formatSelect.value : 'excel';
+    const button = document.getElementById('downloadExcelBtn');
+    const label = button.innerHTML;
+    button.disabled = true;
+    button.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Preparing...';
+    try {
+        await waitForExport(fileType);
+        window.location.href = `/download/${sessionId}/${fileType}`;
+    } catch (error) {
+        console.error(`❌ ${fileType} download failed:`, error);
+        showError(error.message);
+    } finally {
+        button.disabled = false;
+        button.innerHTML = label;
+    }
 }
 
 function downloadMap() {
@@ -829,7 +1015,7 @@ function downloadMap() {
         </div>
     </div>
     <script>
-        const data = ${JSON.stringify(analysisData)};
+        const data = ${JSON.stringify(mapPoints || { gov: [], custom: [] })};
         const map = L.map('map').setView([29.0, 67.0], 7);
         L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
             attribution: '© OpenStreetMap contributors'
@@ -837,7 +1023,7 @@ function downloadMap() {
         
         const markers = [];
         
-        data.results.forEach(result => {
+        data.gov.forEach(result => {
             if (result.gov_latitude && result.gov_longitude) {
                 const marker = L.circleMarker([result.gov_latitude, result.gov_longitude], {
                     radius: 6,